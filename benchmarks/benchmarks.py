@@ -0,0 +1,185 @@
+"""
+This file has the benchmark suite for the hot paths of the npm package: the
+wgm_resonator frequency scans, the oscilloscope reader, the resonator
+calculators and the import of the package itself. Each benchmark is timed as
+the best of a few repeats, the results can be saved as a JSON baseline, and a
+later run can be compared against a baseline to flag regressions, e.g.
+
+    python benchmarks/benchmarks.py --save baseline.json
+    python benchmarks/benchmarks.py --compare baseline.json
+
+Everything runs offline: the simulations use the parameters below rather than
+parameter files and the oscilloscope data is synthetic.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import matplotlib
+matplotlib.use('Agg')
+
+material = {'n0':1.444, 'n2':2.7e-16}
+resonator_params = {'Q':1e8, 'lambda':1550, 'r':1500, 'Aeff':50}
+
+def bestTime(func, repeat=3):
+    """
+    This function returns the shortest wall time of repeat calls of func, in
+    seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def writeKeysightCsv(filename, samples, nChannels=2, seed=0):
+    """
+    This function writes a synthetic csv file in the format saved by a
+    KeySight DSOX2024A oscilloscope: a header of the channel names, a row of
+    units and then the samples.
+    """
+    rng = np.random.default_rng(seed)
+    time = np.linspace(-1e-3, 1e-3, samples)
+    data = np.column_stack([time] + [np.sin(2*np.pi*(k + 1)*1e3*time) +
+                                     0.01*rng.standard_normal(samples)
+                                     for k in range(nChannels)])
+    header = ','.join(['x-axis'] + [str(k + 1) for k in range(nChannels)])
+    units = ','.join(['second'] + ['Volt']*nChannels)
+    np.savetxt(filename, data, delimiter=',', fmt='%.6e',
+               header=header + '\n' + units, comments='')
+
+def _scanBenchmark(N, **kwargs):
+    import npm
+    sim = npm.wgm_resonator(material=material,
+                            resonator_params=resonator_params)
+    def run():
+        sim.frequencyScan(N=N, plot=False, progress=False,
+                          rng=np.random.default_rng(0), **kwargs)
+    return run
+
+def _readerBenchmark(directory, samples):
+    import npm
+    filename = os.path.join(directory, 'scope_{}.csv'.format(samples))
+    if not os.path.exists(filename):
+        writeKeysightCsv(filename, samples)
+    return lambda: npm.oscilloscopeReader(filename)
+
+def _calculatorBenchmark(size):
+    import npm
+    rng = np.random.default_rng(0)
+    Q = 10**rng.uniform(5, 9, size)
+    lam = rng.uniform(1.0, 2.0, size)
+    FWHM = rng.uniform(0.1, 1.0, size)
+    def run():
+        npm.FSR_Calculator(Q=Q, lam=lam)
+        npm.Q_calculator(lam=lam, FWHM=FWHM)
+        npm.lifetimeCalculator(lam=lam, Q=Q)
+        npm.ratioCalculator(ratio=FWHM)
+    return run
+
+def _importBenchmark():
+    command = [sys.executable, '-c', 'import npm']
+    env = dict(os.environ, PYTHONPATH=root, MPLBACKEND='Agg')
+    return lambda: subprocess.run(command, env=env, check=True)
+
+def benchmarks(directory, quick=False):
+    """
+    This function returns the dictionary of benchmark names and the
+    functions to time, with smaller sizes if quick is True. Files needed by
+    the benchmarks are written to directory.
+    """
+    scale = 10 if quick else 1
+    cases = {}
+    # The largest size of each scan is cut to one of its own in quick mode,
+    # so no two cases share a name
+    for N in [10, 100, 300 if quick else 1000]:
+        cases['frequencyScan/sequential/N={}'.format(N)] = (
+            lambda N=N: _scanBenchmark(N))
+    for N in [100, 1000, 3000 if quick else 10000]:
+        cases['frequencyScan/batch/N={}'.format(N)] = (
+            lambda N=N: _scanBenchmark(N, batch=True))
+    cases['frequencyScan/dopri5/N=100'] = (
+        lambda: _scanBenchmark(100, integrator='dopri5'))
+    cases['frequencyScan/oscillation/N=3'] = (
+        lambda: _scanBenchmark(3, oscillation=True, amp=0.05, freq=5))
+    for samples in [10**5, 2*10**6//scale]:
+        cases['oscilloscopeReader/samples={}'.format(samples)] = (
+            lambda samples=samples: _readerBenchmark(directory, samples))
+    cases['resonatorCalculator/size={}'.format(10**6//scale)] = (
+        lambda: _calculatorBenchmark(10**6//scale))
+    cases['import npm'] = _importBenchmark
+    return cases
+
+def runBenchmarks(only=None, quick=False, repeat=3):
+    """
+    This function runs the benchmarks whose names contain only (all of them
+    by default) and returns the dictionary of results, holding the best time
+    of each in seconds and a description of the machine.
+    """
+    results = {'machine':{'python':platform.python_version(),
+                          'numpy':np.__version__,
+                          'platform':platform.platform(),
+                          'processor':platform.processor(),
+                          'cpus':os.cpu_count()},
+               'times':{}}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, setup in benchmarks(directory, quick).items():
+            if only is not None and only not in name:
+                continue
+            func = setup()
+            results['times'][name] = bestTime(func, repeat)
+            print('{:<45}{:10.4f} s'.format(name, results['times'][name]))
+    return results
+
+def compareResults(results, baseline, threshold=1.2):
+    """
+    This function compares the times of results with those of a baseline and
+    returns the list of (name, baseline time, time, ratio) for each benchmark
+    that is slower than threshold times its baseline.
+    """
+    regressions = []
+    for name, t in results['times'].items():
+        if name not in baseline['times']:
+            continue
+        ratio = t/baseline['times'][name]
+        if ratio > threshold:
+            regressions.append((name, baseline['times'][name], t, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the npm package')
+    parser.add_argument('--only', help='only run benchmarks containing this')
+    parser.add_argument('--quick', action='store_true',
+                        help='run smaller benchmark sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio flagged as a regression')
+    args = parser.parse_args(argv)
+    results = runBenchmarks(args.only, args.quick, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline, args.threshold)
+        for name, old, new, ratio in regressions:
+            print('REGRESSION {}: {:.4f} s -> {:.4f} s ({:.2f}x)'.format(
+                name, old, new, ratio))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,3 +9,15 @@ from .wgm_resonator import *
 from .txtsave import *
 from .resonatorCalculator import *
 from.oscilloscopeReader import *
+from .integrators import *
+from .continuation import *
+from .sweep import *
+from .resultStore import *
+from .simCache import *
+from .stability import *
+from .wgm_multimode import *
+from .printProgressBar import *
+from .instrumentation import *
+from .paramLibrary import *
+from .resonanceFit import *
+from .sweepSegmentation import *
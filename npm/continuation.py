@@ -0,0 +1,268 @@
+"""
+This file has the pseudo-arclength continuation used to follow the steady
+state branches of the wgm_resonator equations through folds and
+symmetry-breaking bifurcations. The branches are traced in the space of
+u = (I1, I2, Delta), where the steady states satisfy the intensity equations
+of _steadyStateResidual.
+"""
+import numpy as np
+from .wgm_resonator import _steadyStateResidual, _solveSteadyStates
+
+
+def _extendedSystem(u, p1, p2):
+    """
+    This function returns the steady state residual F(u) and its 2x3
+    Jacobian with respect to u = (I1, I2, Delta).
+    """
+    I1, I2, Delta = u
+    F1, F2, (J11, J12, J21, J22) = _steadyStateResidual(I1, I2, p1, p2, Delta)
+    # Derivatives of the residual with respect to the detuning
+    J13 = -2*I1*(I1 + 2*I2 - Delta)
+    J23 = -2*I2*(I2 + 2*I1 - Delta)
+    return np.array([F1, F2]), np.array([[J11, J12, J13], [J21, J22, J23]])
+
+def _tangent(J, tPrev):
+    """
+    This function returns the unit tangent to the branch (the null vector of
+    J) oriented along tPrev, together with the signed size of J's null
+    vector, whose sign changes when a branch point is crossed.
+    """
+    n = np.cross(J[0], J[1])
+    size = np.linalg.norm(n)
+    t = n/size if size > 0 else tPrev
+    sign = 1.0 if np.dot(t, tPrev) >= 0 else -1.0
+    return sign*t, sign*size
+
+def _correct(uPred, t, p1, p2, tol, maxIter):
+    """
+    This function runs the Newton corrector for the predicted point uPred,
+    solving F(u) = 0 together with the arclength condition t.(u - uPred) = 0.
+    Returns the corrected point, or None if Newton did not converge.
+    """
+    u = uPred.copy()
+    for _ in range(maxIter):
+        F, J = _extendedSystem(u, p1, p2)
+        A = np.vstack([J, t])
+        b = np.append(F, np.dot(t, u - uPred))
+        try:
+            du = np.linalg.solve(A, b)
+        except np.linalg.LinAlgError:
+            return None
+        u -= du
+        if np.linalg.norm(du) < tol:
+            return u
+    return None
+
+def _refineFold(u, p1, p2, tol=1e-10, maxIter=20):
+    """
+    This function refines the estimate u of a fold by Newton's method on the
+    steady state equations together with the fold condition, that the 2x2
+    Jacobian with respect to the intensities is singular (so the branch is
+    vertical in detuning). Returns the refined fold, or u if Newton does not
+    converge.
+    """
+    def system(v):
+        F, J = _extendedSystem(v, p1, p2)
+        return np.append(F, np.linalg.det(J[:, :2])), J
+
+    x = np.array(u, dtype=float)
+    h = 1e-7
+    for _ in range(maxIter):
+        G, J = system(x)
+        # Gradient of the determinant by central differences
+        grad = [(system(x + h*e)[0][2] - system(x - h*e)[0][2])/(2*h)
+                for e in np.eye(3)]
+        try:
+            dx = np.linalg.solve(np.vstack([J, grad]), G)
+        except np.linalg.LinAlgError:
+            return u
+        x -= dx
+        if np.linalg.norm(dx) < tol:
+            return x
+    return u
+
+def _refineBranchPoint(u, p1, p2, tol=1e-10, maxIter=20):
+    """
+    This function refines the estimate u of a branch point by Newton's
+    method on Moore's extended system F(u) + mu*phi = 0, J(u)^T phi = 0,
+    |phi| = 1, where phi is the left null vector of the 2x3 Jacobian J (so
+    J has rank one, as at the crossing of two branches) and mu, which is
+    zero at a branch point, makes the system square. Returns the refined
+    branch point, or u if Newton does not converge.
+    """
+    def system(v):
+        F, J = _extendedSystem(v[:3], p1, p2)
+        phi, mu = v[3:5], v[5]
+        return np.concatenate([F + mu*phi, J.T @ phi, [phi @ phi - 1]])
+
+    u = np.array(u, dtype=float)
+    phi = np.linalg.svd(_extendedSystem(u, p1, p2)[1])[0][:, -1]
+    x = np.concatenate([u, phi, [0]])
+    h = 1e-7
+    for _ in range(maxIter):
+        G = system(x)
+        # Jacobian of the whole system by central differences
+        A = np.array([(system(x + h*e) - system(x - h*e))/(2*h)
+                      for e in np.eye(6)]).T
+        try:
+            dx = np.linalg.solve(A, G)
+        except np.linalg.LinAlgError:
+            return u
+        x -= dx
+        if np.linalg.norm(dx) < tol:
+            return x[:3]
+    return u
+
+def traceBranch(u0, t0, p1, p2, Del0, Del1, ds=0.05, dsMin=1e-5, dsMax=0.3,
+                maxSteps=5000, tol=1e-10, maxIter=8, branches=(),
+                knownPoints=()):
+    """
+    This function follows one steady state branch from the point u0 along the
+    direction t0 until it leaves Del0 <= Delta <= Del1, reaches unphysical
+    (negative) intensities, closes on itself, crosses one of the knownPoints
+    (branch points found already, where the branch is closed at that point)
+    or, once it is 2*ds from its start, comes within ds/2 of one of the
+    branches already traced. The step size grows while the corrector
+    converges quickly and is halved when it fails.
+    Returns the branch as an (n, 3) array of (I1, I2, Delta) with the lists
+    of folds and branch points found along it, each branch point given as
+    (u, t), the point and the branch tangent there, the number of corrector
+    solves used and whether it stopped on a known branch or branch point.
+    """
+    u = np.array(u0, dtype=float)
+    ds0 = ds
+    joined = False
+    F, J = _extendedSystem(u, p1, p2)
+    t, size = _tangent(J, np.asarray(t0, dtype=float))
+    points = [u]
+    tangents = [t]
+    sizes = [size]
+    folds = []
+    branchPoints = []
+    solves = 0
+    while len(points) < maxSteps:
+        uNew = _correct(u + ds*t, t, p1, p2, tol, maxIter)
+        solves += 1
+        if uNew is None:
+            ds /= 2
+            if ds < dsMin:
+                break
+            continue
+        F, J = _extendedSystem(uNew, p1, p2)
+        tNew, sizeNew = _tangent(J, t)
+        # A fold is where the branch turns back in detuning
+        if tNew[2]*t[2] < 0:
+            w = t[2]/(t[2] - tNew[2])
+            folds.append(_refineFold(u + w*(uNew - u), p1, p2, tol))
+        # A branch point is where the null vector of J changes sign
+        if sizeNew*size < 0:
+            w = size/(size - sizeNew)
+            uBranch = _refineBranchPoint(u + w*(uNew - u), p1, p2, tol)
+            known = [b for b in knownPoints
+                     if np.linalg.norm(uBranch - b) < 2*ds0]
+            if known:
+                points.append(np.asarray(known[0], dtype=float))
+                joined = True
+                break
+            branchPoints.append((uBranch, t))
+        u, t, size = uNew, tNew, sizeNew
+        points.append(u)
+        tangents.append(t)
+        sizes.append(size)
+        if (not Del0 <= u[2] <= Del1) or min(u[0], u[1]) < -tol:
+            break
+        if (np.linalg.norm(u - points[0]) > 2*ds0 and
+                _onBranches(u, branches, ds0/2)):
+            joined = True
+            break
+        if len(points) > 10 and np.linalg.norm(u - points[0]) < ds:
+            points.append(points[0])
+            break
+        ds = min(1.3*ds, dsMax)
+    return np.array(points), folds, branchPoints, solves, joined
+
+def _switchDirection(u, t, p1, p2):
+    """
+    This function returns the tangent of the crossing branch at the branch
+    point u, i.e. the part of J's two dimensional null space there that is
+    orthogonal to the tangent t of the branch that has been followed.
+    """
+    F, J = _extendedSystem(u, p1, p2)
+    null = np.linalg.svd(J)[2][1:]
+    candidates = [v - np.dot(v, t)*t for v in null]
+    v = max(candidates, key=np.linalg.norm)
+    return v/np.linalg.norm(v)
+
+def _onBranches(u, branches, distance):
+    """
+    This function checks whether the point u lies within distance of one of
+    the branches that have already been traced, measuring to the segments
+    between the traced points.
+    """
+    for branch in branches:
+        if len(branch) < 2:
+            continue
+        a = branch[:-1]
+        d = np.diff(branch, axis=0)
+        with np.errstate(invalid='ignore'):
+            s = np.clip(np.sum((u - a)*d, axis=1)/np.sum(d*d, axis=1), 0, 1)
+        closest = a + np.nan_to_num(s)[:, np.newaxis]*d
+        if np.min(np.linalg.norm(closest - u, axis=1)) < distance:
+            return True
+    return False
+
+def continueBranches(Del0=-4, Del1=7, p1=1.4, p2=1.4, ds=0.05, dsMin=1e-5,
+                     dsMax=0.3, maxSteps=5000, tol=1e-10, maxBranches=20):
+    """
+    This function traces every steady state branch in Del0 <= Delta <= Del1
+    by pseudo-arclength continuation. Branches are started from the steady
+    states at both ends of the detuning range and from every branch point
+    found along the way, so the symmetry-broken branches are followed as
+    well as the symmetric one. A branch stops where it reaches a branch
+    point or branch that is already known, and a trace that only follows a
+    known branch is dropped.
+    Returns the list of branches, each an (n, 3) array of (I1, I2, Delta),
+    with (k, 3) arrays of the fold points and branch points and the total
+    number of corrector solves.
+    """
+    seeds = []
+    for Delta, direction in [(Del0, 1.0), (Del1, -1.0)]:
+        I1, I2 = _solveSteadyStates([Delta], p1, p2)
+        for i1, i2 in zip(I1[0], I2[0]):
+            if not np.isnan(i1):
+                seeds.append((np.array([i1, i2, Delta]),
+                              np.array([0, 0, direction])))
+    branches = []
+    folds = []
+    branchPoints = []
+    solves = 0
+    while seeds and len(branches) < maxBranches:
+        u0, t0 = seeds.pop(0)
+        if _onBranches(u0, branches, ds/2):
+            continue
+        branch, newFolds, newBranchPoints, n, joined = traceBranch(
+            u0, t0, p1, p2, Del0, Del1, ds, dsMin, dsMax, maxSteps, tol,
+            branches=branches, knownPoints=branchPoints)
+        solves += n
+        if joined and all(_onBranches(u, branches, 2*ds) for u in branch):
+            continue
+        branches.append(branch)
+        folds += newFolds
+        for u, t in newBranchPoints:
+            if any(np.linalg.norm(u - b) < 2*ds for b in branchPoints):
+                continue
+            branchPoints.append(u)
+            # Follow the crossing branch both ways, starting a small step
+            # away from the branch point so it is not found again at once
+            v = _switchDirection(u, t, p1, p2)
+            for direction in [v, -v]:
+                uStart = _correct(u + ds*direction, direction, p1, p2, tol, 8)
+                if uStart is not None:
+                    seeds.append((uStart, direction))
+    # Symmetry-broken branches turn back in detuning at their branch point,
+    # which is not a fold of the branch
+    folds = [f for f in folds
+             if not any(np.linalg.norm(f - b) < 2*ds for b in branchPoints)]
+    folds = np.array(folds).reshape(-1, 3)
+    branchPoints = np.array(branchPoints).reshape(-1, 3)
+    return branches, folds, branchPoints, solves
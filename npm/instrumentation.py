@@ -0,0 +1,124 @@
+"""
+This file has the instrumentation used by the wgm_resonator simulations: a
+throttled progress reporter that can drive any callback (the terminal
+progress bar by default) without slowing the stepping loops, and a profiler
+that splits the time of a run between integration, random number generation,
+stability analysis and plotting.
+"""
+import time
+from contextlib import contextmanager
+from .printProgressBar import printProgressBar
+
+
+def progressBar(prefix='Scanning frequency', length=50):
+    """
+    This function returns a progress callback, taking the number of points
+    done and the total, that draws the terminal progress bar.
+    """
+    def callback(iteration, total):
+        printProgressBar(iteration=iteration, total=total, prefix=prefix,
+                         length=length)
+    return callback
+
+class progressReporter:
+    """
+    This object passes the progress of a run to callback(iteration, total),
+    at most once every interval seconds (and always when the run finishes),
+    so it can be updated on every step of a loop at the cost of a clock
+    read. A callback of True uses progressBar and None or False reports
+    nothing.
+    """
+    def __init__(self, callback, total, interval=0.1):
+        if callback is True:
+            callback = progressBar()
+        self.callback = callback or None
+        self.total = total
+        self.interval = interval
+        self._last = -float('inf')
+
+    def update(self, iteration):
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        if now - self._last >= self.interval or iteration >= self.total:
+            self._last = now
+            self.callback(iteration, self.total)
+
+class scanProfiler:
+    """
+    This object accumulates the wall time spent in named sections of a run.
+    Time in random number generation is measured by wrapping the generator
+    (see timedRng) and is taken out of the section it was drawn in, so the
+    integration time does not include it.
+    """
+    def __init__(self):
+        self.times = {}
+        self._rngTime = 0.0
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    @contextmanager
+    def section(self, name):
+        """
+        This times the code in a with block as the named section.
+        """
+        rngStart = self._rngTime
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            drawn = self._rngTime - rngStart
+            self.add(name, elapsed - drawn)
+            self.add('rng', drawn)
+
+    def timedRng(self, rng):
+        """
+        This returns rng wrapped so the time spent drawing from it is
+        recorded.
+        """
+        return _timedRng(rng, self)
+
+    def report(self):
+        """
+        This returns the time in each section with the total, in seconds.
+        """
+        times = dict(self.times)
+        times['total'] = sum(self.times.values())
+        return times
+
+    def summary(self):
+        """
+        This returns the report as a table of seconds and percentages.
+        """
+        times = self.report()
+        total = times['total'] or 1.0
+        return '\n'.join('{:<12}{:10.3f} s{:7.1f} %'.format(name, t,
+                                                            100*t/total)
+                         for name, t in times.items())
+
+class _timedRng:
+    """
+    This object wraps a random generator (numpy.random or a Generator),
+    timing its normal and standard_normal draws for a scanProfiler and
+    passing everything else straight through.
+    """
+    def __init__(self, rng, profiler):
+        self._rng = rng
+        self._profiler = profiler
+
+    def _timed(self, draw, *args, **kwargs):
+        start = time.perf_counter()
+        value = draw(*args, **kwargs)
+        self._profiler._rngTime += time.perf_counter() - start
+        return value
+
+    def normal(self, *args, **kwargs):
+        return self._timed(self._rng.normal, *args, **kwargs)
+
+    def standard_normal(self, *args, **kwargs):
+        return self._timed(self._rng.standard_normal, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._rng, name)
@@ -0,0 +1,112 @@
+"""
+This file has the time integrators used by the wgm_resonator simulations. Each
+integrator steps a batch of independent points at once: the state y is a
+complex array of shape (components, points) and the step size h holds one
+value per point, so adaptive integrators can choose a different step for
+every detuning in a batch scan.
+"""
+import numpy as np
+
+
+class eulerIntegrator:
+    """
+    This object is the fixed-step forward Euler integrator, kept as the
+    reference method for the simulations.
+    """
+    adaptive = False
+    stages = 1 # Derivative evaluations per attempted step
+
+    def __init__(self, dt=0.01):
+        self.dt = dt
+
+    def step(self, f, t, y, h, k1=None):
+        """
+        This takes one step of size h from (t, y) for the derivative function
+        f(t, y) and returns the new state, the next step size, a mask of the
+        points whose step was accepted and the derivative to reuse at the
+        start of the next step (None here).
+        """
+        if k1 is None:
+            k1 = f(t, y)
+        accepted = np.ones(np.shape(h), dtype=bool)
+        return y + h*k1, h, accepted, None
+
+
+class dormandPrinceIntegrator:
+    """
+    This object is the embedded Dormand-Prince 5(4) integrator with error
+    control on every point of the batch. A step is accepted when the
+    estimated local error is within atol + rtol*|y| for all components of
+    that point, and the step size is then adapted per point.
+    """
+    adaptive = True
+    stages = 6 # First-same-as-last saves one of the seven evaluations
+    c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+    a = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+         [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+    e = np.array([71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525,
+                  -1/40])
+
+    def __init__(self, dt=0.01, rtol=1e-7, atol=1e-9, dtMin=1e-8, dtMax=10.0,
+                 safety=0.9, facMin=0.2, facMax=5.0):
+        self.dt = dt # Initial step size
+        self.rtol = rtol
+        self.atol = atol
+        self.dtMin = dtMin
+        self.dtMax = dtMax
+        self.safety = safety
+        self.facMin = facMin
+        self.facMax = facMax
+
+    def step(self, f, t, y, h, k1=None):
+        """
+        This attempts one step of size h from (t, y) for the derivative
+        function f(t, y). Rejected points keep their state and retry with a
+        smaller step. The returned derivative is f at the accepted state, so
+        it can be passed back in as k1 for the next step.
+        """
+        if k1 is None:
+            k1 = f(t, y)
+        k = [k1]
+        for i in range(1, 7):
+            yi = y + h*sum(aij*kj for aij, kj in zip(self.a[i], k) if aij)
+            k.append(f(t + self.c[i]*h, yi))
+        # The last stage is evaluated at the fifth order solution
+        yNew = yi
+        err = h*sum(ei*ki for ei, ki in zip(self.e, k) if ei)
+        scale = self.atol + self.rtol*np.maximum(abs(y), abs(yNew))
+        errNorm = np.sqrt(np.mean(abs(err/scale)**2, axis=0))
+        accepted = errNorm <= 1
+        with np.errstate(divide='ignore'):
+            fac = self.safety*errNorm**-0.2
+        fac = np.clip(fac, self.facMin, np.where(accepted, self.facMax, 1.0))
+        hNext = np.clip(h*fac, self.dtMin, self.dtMax)
+        # Points at the minimum step size are accepted to guarantee progress
+        accepted |= h <= self.dtMin
+        yNew = np.where(accepted, yNew, y)
+        kNext = np.where(accepted, k[6], k1)
+        return yNew, hNext, accepted, kNext
+
+
+integrators = {'euler':eulerIntegrator,
+               'dopri5':dormandPrinceIntegrator}
+
+def getIntegrator(integrator='euler', **kwargs):
+    """
+    This function returns an integrator object, either passing through one
+    that has already been created or building one from its name in
+    integrators with the given settings (e.g. dt, rtol, atol).
+    """
+    if not isinstance(integrator, str):
+        return integrator
+    assert integrator in integrators, ('Unknown integrator {}, choose from '
+                                       '{}'.format(integrator,
+                                                   list(integrators)))
+    if integrator == 'euler':
+        kwargs = {'dt':kwargs.get('dt', 0.01)}
+    return integrators[integrator](**kwargs)
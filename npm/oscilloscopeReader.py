@@ -1,24 +1,713 @@
-import pandas as pd
+import os
+import glob
+import json
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
+from .txtsave import _atomicWrite, _writeJson
 
+scopeCacheDir = '.scope_cache' # Cache directory, next to the csv files
+_cacheVersion = 2 # Sidecars of older layouts are parsed again
 
-def oscilloscopeReader(filename, plot=False):
+# Layout of the headers of a KeySight binary waveform (.bin) file
+binFileHeader = np.dtype([('cookie', 'S2'), ('version', 'S2'),
+                          ('fileSize', '<i4'), ('nWaveforms', '<i4')])
+binWaveformHeader = np.dtype([('headerSize', '<i4'), ('waveformType', '<i4'),
+                              ('nBuffers', '<i4'), ('nPoints', '<i4'),
+                              ('count', '<i4'), ('xDisplayRange', '<f4'),
+                              ('xDisplayOrigin', '<f8'),
+                              ('xIncrement', '<f8'), ('xOrigin', '<f8'),
+                              ('xUnits', '<i4'), ('yUnits', '<i4'),
+                              ('date', 'S16'), ('time', 'S16'),
+                              ('frame', 'S24'), ('label', 'S16'),
+                              ('timeTag', '<f8'), ('segmentIndex', '<u4')])
+binDataHeader = np.dtype([('headerSize', '<i4'), ('bufferType', '<i2'),
+                          ('bytesPerPoint', '<i2'), ('bufferSize', '<i4')])
+# Sample type and name suffix of each buffer type
+binBufferTypes = {0:('<f4', ''), 1:('<f4', ''), 2:('<f4', '_max'),
+                  3:('<f4', '_min'), 4:('<f4', '_time'), 5:('<i4', '_counts'),
+                  6:('u1', '_logic')}
+
+
+def _readHeader(f):
     """
-    This function reads a csv file from a KeySight DSOX2024A oscilloscope and
-    outputs the data from all relevant channels
+    This function reads the two header lines of a KeySight csv file, the
+    column names and their units, from the open file f.
+    """
+    names = f.readline().rstrip('\r\n').split(',')
+    units = f.readline().rstrip('\r\n').split(',')
+    return names, units
+
+def _columnTypes(names, dtype):
+    """
+    This function returns the structured dtype of the columns names: the
+    time ('x-axis') is always float64, since a narrow dtype cannot resolve
+    the sample interval of a long capture against its offset, and the
+    channels are dtype.
+    """
+    return np.dtype([(i, np.float64 if i == 'x-axis' else dtype)
+                     for i in names])
+
+def _splitColumns(data):
+    """
+    This function returns the time and the dictionary of channels held in
+    the fields of the structured array data.
     """
-    data = pd.read_csv(filename)
     channels = {}
-    for i in data:
+    for i in data.dtype.names:
         if i == 'x-axis':
-            time = data[i][2:].astype('float').to_numpy()
+            time = data[i]
         else:
-            channels[i] = data[i][2:].astype('float').to_numpy()
-            
+            channels[i] = data[i]
+    return time, channels
+
+def readKeysightCsv(filename, dtype=np.float64):
+    """
+    This function parses a csv file from a KeySight DSOX2024A oscilloscope
+    in a single pass: the header and units lines are read once and the
+    numeric body goes straight into one structured array with a field for
+    each column, the time as float64 and the channels as dtype. As in the
+    original reader, the first sample after the units line is skipped.
+    Returns the array with the column names and units.
+    """
+    with open(filename, 'r') as f:
+        names, units = _readHeader(f)
+        f.readline()
+        data = np.loadtxt(f, delimiter=',', dtype=_columnTypes(names, dtype),
+                          ndmin=1, usecols=range(len(names)))
+    return data, names, units
+
+def _cacheFiles(filename, dtype, cache):
+    """
+    This function returns the sidecar .npy and .json filenames for the csv
+    file filename read as dtype, in the directory cache (or the default
+    cache directory next to the file if cache is True).
+    """
+    source = os.path.abspath(os.fspath(filename))
+    if cache is True:
+        cache = os.path.join(os.path.dirname(source), scopeCacheDir)
+    key = hashlib.sha1('{}|{}'.format(source, np.dtype(dtype).str).encode())
+    base = os.path.join(cache, key.hexdigest()[:20])
+    return base + '.npy', base + '.json'
+
+def _sourceStamp(filename):
+    """
+    This function returns what a sidecar is keyed on: the absolute path,
+    size and modification time of its csv file.
+    """
+    stat = os.stat(filename)
+    return {'source':os.path.abspath(filename), 'size':stat.st_size,
+            'mtime_ns':stat.st_mtime_ns}
+
+def _readCached(filename, dtype, cache):
+    """
+    This function returns the data of filename from its sidecar in the
+    cache, memory-mapped read-only, converting the csv file into the sidecar
+    first if it is missing or the file has changed since it was made.
+    """
+    npyFile, jsonFile = _cacheFiles(filename, dtype, cache)
+    stamp = _sourceStamp(filename)
+    try:
+        with open(jsonFile, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    if (meta is None or meta['stamp'] != stamp or
+            meta.get('version') != _cacheVersion or
+            not os.path.exists(npyFile)):
+        data, names, units = readKeysightCsv(filename, dtype)
+        os.makedirs(os.path.dirname(npyFile), exist_ok=True)
+        with _atomicWrite(npyFile, 'wb') as f:
+            np.save(f, data)
+        meta = {'stamp':stamp, 'names':names, 'units':units,
+                'version':_cacheVersion}
+        _writeJson(meta, jsonFile)
+    return np.load(npyFile, mmap_mode='r'), meta['names'], meta['units']
+
+def invalidateScopeCache(filename, cache=True):
+    """
+    This function removes the sidecars of filename from the cache, for every
+    dtype it has been read as.
+    """
+    directory = os.path.dirname(_cacheFiles(filename, np.float64, cache)[0])
+    if not os.path.isdir(directory):
+        return
+    source = os.path.abspath(filename)
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            jsonFile = os.path.join(directory, name)
+            try:
+                with open(jsonFile, 'r') as f:
+                    ours = json.load(f)['stamp']['source'] == source
+            except (OSError, ValueError, KeyError):
+                continue
+            if ours:
+                _removeSidecar(jsonFile)
+
+def cleanScopeCache(directory, everything=False):
+    """
+    This function removes the stale sidecars from a cache directory, those
+    whose csv file has been deleted or changed, or every sidecar if
+    everything is True. Returns the number of sidecars removed.
+    """
+    removed = 0
+    if not os.path.isdir(directory):
+        return removed
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        jsonFile = os.path.join(directory, name)
+        try:
+            with open(jsonFile, 'r') as f:
+                stamp = json.load(f)['stamp']
+            stale = _sourceStamp(stamp['source']) != stamp
+        except (OSError, ValueError, KeyError):
+            stale = True
+        if everything or stale:
+            _removeSidecar(jsonFile)
+            removed += 1
+    return removed
+
+def _removeSidecar(jsonFile):
+    for sidecar in [jsonFile, jsonFile[:-5] + '.npy']:
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+def oscilloscopeReader(filename, plot=False, dtype=np.float64, cache=False):
+    """
+    This function reads a csv file from a KeySight DSOX2024A oscilloscope and
+    outputs the data from all relevant channels. The time and channels are
+    views into a single array parsed with readKeysightCsv, so no column is
+    copied (use dtype=np.float32 to halve the memory of the channels of long
+    captures; the time is always float64).
+    With cache=True (or a cache directory), the parsed data is kept in a
+    binary .npy sidecar, by default in .scope_cache next to the file, keyed
+    on the file's path, size and modification time. Later reads of the
+    unchanged file memory-map the sidecar instead of parsing the text (see
+    invalidateScopeCache and cleanScopeCache).
+    Binary waveform files (.bin) are read with keysightBinReader. Traces are
+    decimated to about 4000 points for plotting (see decimate).
+    """
+    if os.fspath(filename).lower().endswith('.bin'):
+        return keysightBinReader(filename, plot)
+    if cache:
+        data, names, units = _readCached(filename, dtype, cache)
+    else:
+        data, names, units = readKeysightCsv(filename, dtype)
+    time, channels = _splitColumns(data)
+
+    if plot:
+        # Reduce each trace to about screen resolution, keeping its envelope
+        for i in channels.keys():
+            plt.plot(*decimate(time,channels[i]),label='Ch: {}'.format(i))
+        plt.legend()
+
+    return time, channels
+
+def keysightBinInfo(filename):
+    """
+    This function parses the headers of a KeySight binary waveform (.bin)
+    file without reading any samples. Returns a list with a dictionary of
+    the header of each waveform, including its label and the 'buffers' it
+    holds as (name, sample dtype, byte offset, number of samples).
+    """
+    header = np.fromfile(filename, dtype=binFileHeader, count=1)[0]
+    assert header['cookie'] == b'AG', ('{} is not a KeySight binary waveform '
+                                       'file'.format(filename))
+    offset = binFileHeader.itemsize
+    waveforms = []
+    labels = []
+    for k in range(int(header['nWaveforms'])):
+        waveform = np.fromfile(filename, dtype=binWaveformHeader, count=1,
+                               offset=offset)[0]
+        offset += int(waveform['headerSize'])
+        info = {name:waveform[name].item() for name in binWaveformHeader.names}
+        label = waveform['label'].split(b'\0')[0].decode().strip()
+        label = label or str(k + 1)
+        if label in labels:
+            # Segmented captures repeat the label of each channel
+            label += '_seg{}'.format(waveform['segmentIndex'])
+        labels.append(label)
+        info['label'] = label
+        info['buffers'] = []
+        for _ in range(int(waveform['nBuffers'])):
+            data = np.fromfile(filename, dtype=binDataHeader, count=1,
+                               offset=offset)[0]
+            offset += int(data['headerSize'])
+            sample, suffix = binBufferTypes.get(data['bufferType'],
+                                                binBufferTypes[0])
+            if np.dtype(sample).itemsize != data['bytesPerPoint']:
+                sample = 'u{}'.format(data['bytesPerPoint'])
+            info['buffers'].append((label + suffix, sample, offset,
+                                    int(data['bufferSize'])//
+                                    int(data['bytesPerPoint'])))
+            offset += int(data['bufferSize'])
+        waveforms.append(info)
+    return waveforms
+
+def keysightBinReader(filename, plot=False):
+    """
+    This function reads a binary waveform (.bin) file saved by a KeySight
+    oscilloscope and outputs the time and channels in the same form as
+    oscilloscopeReader. Only the headers are parsed (see keysightBinInfo):
+    each channel is a read-only view over the memory-mapped file, already in
+    volts for analogue waveforms, so no samples are read until they are used.
+    The time axis is rebuilt from the x origin and x increment of the first
+    waveform.
+    """
+    waveforms = keysightBinInfo(filename)
+    channels = {}
+    for info in waveforms:
+        for name, sample, offset, n in info['buffers']:
+            channels[name] = np.memmap(filename, dtype=sample, mode='r',
+                                       offset=offset, shape=(n,))
+    first = waveforms[0]
+    time = first['xOrigin'] + first['xIncrement']*np.arange(first['nPoints'])
+
     if plot:
         for i in channels.keys():
-            plt.plot(time,channels[i],label='Ch: {}'.format(i))
+            plt.plot(*decimate(time[:len(channels[i])],channels[i]),
+                     label='Ch: {}'.format(i))
         plt.legend()
-    
+
     return time, channels
+
+def decimateMinMax(time, y, buckets=2000):
+    """
+    This function reduces a trace to the minimum and maximum of each of
+    buckets equal groups of samples, kept in time order, so narrow dips and
+    spikes survive however far the trace is reduced. Returns the decimated
+    time and y (at most 2*buckets samples).
+    """
+    n = len(y)
+    if n <= 2*buckets:
+        return time, y
+    size = -(-n//buckets)
+    rows = -(-n//size)
+    padded = np.pad(np.asarray(y), (0, rows*size - n), mode='edge')
+    padded = padded.reshape(rows, size)
+    start = np.arange(rows)*size
+    iMin = np.minimum(start + padded.argmin(axis=1), n - 1)
+    iMax = np.minimum(start + padded.argmax(axis=1), n - 1)
+    index = np.stack([np.minimum(iMin, iMax), np.maximum(iMin, iMax)],
+                     axis=1).ravel()
+    return time[index], y[index]
+
+def decimateLTTB(time, y, points=2000):
+    """
+    This function reduces a trace to points samples with the
+    Largest-Triangle-Three-Buckets method: the first and last samples are
+    kept, and from each bucket in between the sample making the largest
+    triangle with the sample kept from the previous bucket and the mean of
+    the next bucket. Returns the decimated time and y.
+    """
+    n = len(y)
+    if n <= points or points < 3:
+        return time, y
+    t = np.asarray(time, dtype=np.float64)
+    v = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    index = np.zeros(points, dtype=int)
+    index[-1] = n - 1
+    for k in range(points - 2):
+        lo, hi = edges[k], max(edges[k + 1], edges[k] + 1)
+        if k + 2 < len(edges):
+            nextLo, nextHi = edges[k + 1], max(edges[k + 2], edges[k + 1] + 1)
+            tNext, vNext = t[nextLo:nextHi].mean(), v[nextLo:nextHi].mean()
+        else:
+            tNext, vNext = t[-1], v[-1]
+        a = index[k]
+        area = abs((t[a] - tNext)*(v[lo:hi] - v[a]) -
+                   (t[a] - t[lo:hi])*(vNext - v[a]))
+        index[k + 1] = lo + area.argmax()
+    return time[index], y[index]
+
+decimators = {'minmax':decimateMinMax,
+              'lttb':decimateLTTB}
+
+def decimate(time, y, points=4000, method='minmax'):
+    """
+    This function reduces a trace to about points samples for plotting,
+    with the min/max of each bucket ('minmax', see decimateMinMax) or the
+    Largest-Triangle-Three-Buckets method ('lttb', see decimateLTTB).
+    """
+    assert method in decimators, ('Unknown method {}, choose from '
+                                  '{}'.format(method, list(decimators)))
+    if method == 'minmax':
+        return decimateMinMax(time, y, points//2)
+    return decimateLTTB(time, y, points)
+
+def _csvFiles(files):
+    """
+    This function returns the list of files given as a directory (every
+    .csv file in it), a glob pattern or a list of filenames, any of which
+    may be str or pathlib.Path.
+    """
+    if isinstance(files, (str, os.PathLike)):
+        files = os.fspath(files)
+        if os.path.isdir(files):
+            files = os.path.join(files, '*.csv')
+        return sorted(glob.glob(files))
+    return [os.fspath(i) for i in files]
+
+def _bulkTask(task):
+    """
+    This function reads one file of a bulk load and returns its index with
+    the time, channel names and a (channels, samples) array of the data.
+    """
+    index, filename, dtype, cache = task
+    time, channels = oscilloscopeReader(filename, dtype=dtype, cache=cache)
+    names = list(channels)
+    data = np.array([channels[i] for i in names], dtype=dtype)
+    return index, np.array(time), names, data
+
+def oscilloscopeBulk(files, processes=None, chunksize=None,
+                     dtype=np.float64, cache=False):
+    """
+    This function reads many csv files from a KeySight DSOX2024A oscilloscope
+    at once, spreading them over a pool of processes (all cores by default,
+    processes=1 reads them in this process). files is a directory (every
+    .csv file in it), a glob pattern or a list of filenames.
+    Files may have different lengths and channels: the result is padded with
+    NaN. Returns the (files, samples) array of times, the (files, channels,
+    samples) array of data, the list of channel names and the index of the
+    files, a list of dictionaries holding each file's name, number of
+    samples, channels and sample interval.
+    """
+    files = _csvFiles(files)
+    tasks = [(index, filename, dtype, cache)
+             for index, filename in enumerate(files)]
+    results = [None]*len(tasks)
+    if processes is None:
+        processes = os.cpu_count()
+    if processes == 1 or len(tasks) < 2:
+        for index, *result in map(_bulkTask, tasks):
+            results[index] = result
+    else:
+        if chunksize is None:
+            chunksize = max(1, len(tasks)//(4*processes))
+        with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+            for index, *result in pool.imap_unordered(_bulkTask, tasks,
+                                                      chunksize):
+                results[index] = result
+    names = []
+    for _, fileNames, _ in results:
+        names += [i for i in fileNames if i not in names]
+    samples = max([len(time) for time, _, _ in results], default=0)
+    time = np.full((len(files), samples), np.nan)
+    data = np.full((len(files), len(names), samples), np.nan, dtype=dtype)
+    index = []
+    for k, (fileTime, fileNames, fileData) in enumerate(results):
+        n = len(fileTime)
+        time[k, :n] = fileTime
+        for i, name in enumerate(fileNames):
+            data[k, names.index(name), :n] = fileData[i]
+        index.append({'filename':files[k], 'samples':n,
+                      'channels':fileNames,
+                      'dt':(fileTime[-1] - fileTime[0])/(n - 1) if n > 1
+                      else np.nan})
+    return time, data, names, index
+
+def oscilloscopeBlocks(filename, blockSize=10**6, dtype=np.float64):
+    """
+    This function reads a csv file from a KeySight DSOX2024A oscilloscope
+    block by block, yielding (time, channels) for blockSize samples at a time
+    in the same form as oscilloscopeReader, so only one block is ever held
+    in memory however long the capture is.
+    """
+    with open(filename, 'r') as f:
+        names, units = _readHeader(f)
+        f.readline()
+        while True:
+            lines = list(itertools.islice(f, blockSize))
+            if not lines:
+                break
+            data = np.loadtxt(lines, delimiter=',',
+                              dtype=_columnTypes(names, dtype), ndmin=1,
+                              usecols=range(len(names)))
+            yield _splitColumns(data)
+
+def blockEnvelope(blocks, window):
+    """
+    This function reduces the blocks of oscilloscopeBlocks to the min/max
+    envelope of every channel over consecutive windows of window samples
+    (the last window may be shorter), carrying the samples of a window that
+    is split between blocks over to the next block. Returns the time at the
+    start of each window and dictionaries of the channel minima and maxima.
+    """
+    times = []
+    mins = {}
+    maxs = {}
+
+    def reduce(time, channels):
+        starts = np.arange(0, len(time), window)
+        times.append(time[starts])
+        for i, c in channels.items():
+            mins.setdefault(i, []).append(np.minimum.reduceat(c, starts))
+            maxs.setdefault(i, []).append(np.maximum.reduceat(c, starts))
+
+    carry = None
+    for time, channels in blocks:
+        if carry is not None:
+            time = np.concatenate([carry[0], time])
+            channels = {i:np.concatenate([carry[1][i], c])
+                        for i, c in channels.items()}
+        full = len(time)//window*window
+        if full:
+            reduce(time[:full], {i:c[:full] for i, c in channels.items()})
+        carry = (time[full:], {i:c[full:] for i, c in channels.items()})
+    if carry is not None and len(carry[0]):
+        reduce(*carry)
+    if not times:
+        return np.zeros(0), {}, {}
+    return (np.concatenate(times),
+            {i:np.concatenate(v) for i, v in mins.items()},
+            {i:np.concatenate(v) for i, v in maxs.items()})
+
+def blockMean(blocks):
+    """
+    This function reduces the blocks of oscilloscopeBlocks to the mean of
+    every channel, accumulated block by block. Returns the dictionary of
+    means and the number of samples.
+    """
+    sums = {}
+    count = 0
+    for time, channels in blocks:
+        for i, c in channels.items():
+            sums[i] = sums.get(i, 0.0) + c.sum(dtype=np.float64)
+        count += len(time)
+    return {i:total/count for i, total in sums.items()}, count
+
+def thresholdCrossings(blocks, channel, threshold, direction='rising'):
+    """
+    This function finds the times at which channel crosses threshold in the
+    blocks of oscilloscopeBlocks, 'rising', 'falling' or 'both' ways,
+    interpolating linearly between the samples either side. The last sample
+    of each block is kept so crossings between blocks are found too.
+    """
+    assert direction in ('rising', 'falling', 'both'), ('Unknown direction '
+                                                        '{}'.format(direction))
+    crossings = []
+    last = None
+    for time, channels in blocks:
+        c = channels[channel]
+        if last is not None:
+            time = np.append(last[0], time)
+            c = np.append(last[1], c)
+        above = c >= threshold
+        rising = ~above[:-1] & above[1:]
+        falling = above[:-1] & ~above[1:]
+        found = {'rising':rising, 'falling':falling,
+                 'both':rising | falling}[direction]
+        k = np.flatnonzero(found)
+        w = (threshold - c[k])/(c[k + 1] - c[k])
+        crossings.append(time[k] + w*(time[k + 1] - time[k]))
+        last = (time[-1], c[-1])
+    return np.concatenate(crossings) if crossings else np.zeros(0)
+
+def _mergeMoments(nA, meanA, m2A, nB, meanB, m2B):
+    """
+    This function merges the counts, means and sums of squared deviations of
+    two sets of samples, elementwise (Chan et al.'s pairwise update, which is
+    Welford's when the second set is a single sample).
+    """
+    n = nA + nB
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(n > 0, nB/n, 0)
+    delta = meanB - meanA
+    mean = np.where(nB > 0, meanA + delta*w, meanA)
+    m2 = np.where(nB > 0, m2A + m2B + delta**2*nA*w, m2A)
+    return n, mean, m2
+
+class captureStatistics:
+    """
+    This object averages repeated oscilloscope captures without keeping them:
+    for every channel it holds the running count, mean, sum of squared
+    deviations, minimum and maximum of each sample position, so its memory
+    is that of one capture however many are added. Captures are added whole
+    (add), as the blocks of oscilloscopeBlocks (add with the sample offset
+    start, or addFile), or as stacks of captures such as the data of
+    oscilloscopeBulk (NaN samples are skipped). The moments are updated with
+    Welford's method, which stays accurate when the noise is small compared
+    to the signal, and accumulators filled by parallel workers are combined
+    with merge. Captures of different lengths are allowed: each position
+    counts the captures that reached it.
+    """
+    def __init__(self):
+        self.count = {}
+        self._mean = {}
+        self._m2 = {}
+        self._min = {}
+        self._max = {}
+        self.captures = 0
+
+    def _grow(self, name, length):
+        """
+        This makes the arrays of channel name at least length samples long.
+        """
+        if name not in self.count:
+            self.count[name] = np.zeros(0, dtype=np.int64)
+            self._mean[name] = np.zeros(0)
+            self._m2[name] = np.zeros(0)
+            self._min[name] = np.zeros(0)
+            self._max[name] = np.zeros(0)
+        extra = length - len(self.count[name])
+        if extra > 0:
+            for store, fill in ((self.count, 0), (self._mean, 0.0),
+                                (self._m2, 0.0), (self._min, np.inf),
+                                (self._max, -np.inf)):
+                store[name] = np.concatenate(
+                    [store[name], np.full(extra, fill, dtype=store[name].dtype)])
+
+    def _update(self, name, start, n, mean, m2, low, high):
+        """
+        This merges the moments of a set of samples at positions start
+        onwards into channel name.
+        """
+        stop = start + len(n)
+        self._grow(name, stop)
+        part = slice(start, stop)
+        (self.count[name][part], self._mean[name][part],
+         self._m2[name][part]) = _mergeMoments(
+             self.count[name][part], self._mean[name][part],
+             self._m2[name][part], n, mean, m2)
+        self._min[name][part] = np.fmin(self._min[name][part], low)
+        self._max[name][part] = np.fmax(self._max[name][part], high)
+
+    def add(self, channels, start=0, capture=True):
+        """
+        This adds a capture (or a block of one starting at sample start), a
+        dictionary of channels as returned by oscilloscopeReader. A channel
+        may also be a (captures, samples) stack, which is added in one go.
+        capture says whether to count this as new captures (False for the
+        second and later blocks of a capture).
+        """
+        stacked = 1
+        for name, values in channels.items():
+            values = np.asarray(values, dtype=np.float64)
+            if values.ndim == 1:
+                valid = ~np.isnan(values)
+                self._update(name, start, valid.astype(np.int64),
+                             np.where(valid, values, 0), 0.0, values, values)
+                continue
+            stacked = len(values)
+            n = (~np.isnan(values)).sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(n > 0, np.nansum(values, axis=0)/n, 0)
+            m2 = np.nansum((values - mean)**2, axis=0)
+            low = np.nanmin(np.where(n > 0, values, np.inf), axis=0)
+            high = np.nanmax(np.where(n > 0, values, -np.inf), axis=0)
+            self._update(name, start, n, mean, m2, low, high)
+        if capture:
+            self.captures += stacked
+
+    def addFile(self, filename, blockSize=10**6, dtype=np.float64):
+        """
+        This adds a csv capture, read block by block with oscilloscopeBlocks
+        so it is never held in memory whole.
+        """
+        start = 0
+        for time, channels in oscilloscopeBlocks(filename, blockSize, dtype):
+            self.add(channels, start, capture=start == 0)
+            start += len(time)
+
+    def merge(self, other):
+        """
+        This merges the captures of another captureStatistics into this one,
+        and returns this one.
+        """
+        for name in other.count:
+            self._update(name, 0, other.count[name], other._mean[name],
+                         other._m2[name], other._min[name], other._max[name])
+        self.captures += other.captures
+        return self
+
+    def _masked(self, values, name, minimum=1):
+        """
+        This returns values with NaN where fewer than minimum captures
+        reached the position.
+        """
+        return np.where(self.count[name] >= minimum, values, np.nan)
+
+    @property
+    def mean(self):
+        """
+        This is the mean of every channel over the captures.
+        """
+        return {i:self._masked(self._mean[i], i) for i in self.count}
+
+    def variance(self, ddof=1):
+        """
+        This returns the variance of every channel over the captures, with
+        ddof delta degrees of freedom (the sample variance by default).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {i:self._masked(self._m2[i]/(self.count[i] - ddof), i,
+                                   ddof + 1)
+                    for i in self.count}
+
+    def std(self, ddof=1):
+        """
+        This returns the standard deviation of every channel over the
+        captures.
+        """
+        return {i:np.sqrt(v) for i, v in self.variance(ddof).items()}
+
+    def sem(self):
+        """
+        This returns the standard error of the mean of every channel, i.e.
+        the noise left in the averaged trace.
+        """
+        return {i:s/np.sqrt(self.count[i]) for i, s in self.std().items()}
+
+    @property
+    def min(self):
+        """
+        This is the minimum of every channel over the captures.
+        """
+        return {i:self._masked(self._min[i], i) for i in self.count}
+
+    @property
+    def max(self):
+        """
+        This is the maximum of every channel over the captures.
+        """
+        return {i:self._masked(self._max[i], i) for i in self.count}
+
+def _statisticsTask(task):
+    """
+    This function accumulates one chunk of files for averageCaptures.
+    """
+    files, blockSize, dtype = task
+    stats = captureStatistics()
+    for filename in files:
+        stats.addFile(filename, blockSize, dtype)
+    return stats
+
+def averageCaptures(files, processes=None, blockSize=10**6,
+                    dtype=np.float64):
+    """
+    This function averages many csv captures, a directory, glob pattern or
+    list of filenames as for oscilloscopeBulk, in constant memory: the files
+    are split into one chunk per process, each worker streams its chunk into
+    a captureStatistics, and the workers' results are merged. Returns the
+    captureStatistics, from which mean, variance(), std(), sem(), min and max
+    give dictionaries of the channels.
+    """
+    files = _csvFiles(files)
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(files)))
+    tasks = [(files[i::processes], blockSize, dtype)
+             for i in range(processes)]
+    stats = captureStatistics()
+    if processes == 1:
+        for partial in map(_statisticsTask, tasks):
+            stats.merge(partial)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            for partial in pool.imap_unordered(_statisticsTask, tasks):
+                stats.merge(partial)
+    return stats
@@ -0,0 +1,141 @@
+"""
+This file has the library of material and resonator parameter sets used by
+the wgm_resonator simulations. Every definition in the parameter directory
+is read once, converted to floats and checked against the schema, and is
+then served from memory, so creating many simulation objects costs no file
+I/O.
+"""
+import os
+import numpy as np
+from .txtsave import struct2txt, txt2struct
+
+defaultParamDir = 'params/wgm_resonator_sim'
+
+# The keys every parameter set must have, with their units
+paramSchema = {'material':{'n0':'', 'n2':'cm^2/W'},
+               'resonator_params':{'Q':'', 'lambda':'nm', 'r':'um',
+                                   'Aeff':'um^2'}}
+
+def validateStruct(struct, data_type, name=''):
+    """
+    This function returns a copy of struct with every value converted to a
+    float, raising a ValueError if a key of the schema for data_type is
+    missing or any value is not a finite number.
+    """
+    assert data_type in paramSchema, ('Unknown data type {}, choose from '
+                                      '{}'.format(data_type,
+                                                  list(paramSchema)))
+    missing = [key for key in paramSchema[data_type] if key not in struct]
+    if missing:
+        raise ValueError('The {} {} is missing {}'.format(data_type, name,
+                                                          missing))
+    typed = {}
+    for key, value in struct.items():
+        try:
+            typed[key] = float(value)
+        except (TypeError, ValueError):
+            typed[key] = np.nan
+        if not np.isfinite(typed[key]):
+            raise ValueError('The {} {} has an invalid {}: {!r}'.format(
+                data_type, name, key, value))
+    return typed
+
+class paramLibrary:
+    """
+    This object holds every parameter set in directory, which has one
+    subdirectory per data type ('material' and 'resonator_params') of
+    name.txt files. The files are all read the first time anything is asked
+    for; a file that cannot be read or fails validateStruct only raises its
+    error when that parameter set is asked for, so one bad file does not
+    stop the others being used. A name that is not in the library is asked for at the command line
+    and saved if interactive is True (the original behaviour), otherwise a
+    KeyError is raised, which is what batch jobs need.
+    """
+    def __init__(self, directory=defaultParamDir, interactive=True):
+        self.directory = directory
+        self.interactive = interactive
+        self._entries = None
+
+    def reload(self):
+        """
+        This reads (or re-reads) every parameter file in the directory,
+        keeping the error in place of the parameter set for any file that
+        cannot be read or is invalid.
+        """
+        self._entries = {}
+        for data_type in paramSchema:
+            entries = self._entries[data_type] = {}
+            folder = os.path.join(self.directory, data_type)
+            if not os.path.isdir(folder):
+                continue
+            for filename in sorted(os.listdir(folder)):
+                if filename.endswith('.txt'):
+                    name = filename[:-4]
+                    try:
+                        entries[name] = validateStruct(
+                            txt2struct(os.path.join(folder, filename)),
+                            data_type, name)
+                    except (OSError, ValueError) as error:
+                        entries[name] = error
+
+    def names(self, data_type):
+        """
+        This returns the names of the valid parameter sets of data_type.
+        """
+        if self._entries is None:
+            self.reload()
+        return sorted(name for name, entry in self._entries[data_type].items()
+                      if not isinstance(entry, Exception))
+
+    def get(self, name, data_type, interactive=None):
+        """
+        This returns a copy of the parameter set name of data_type, so it can
+        be changed without affecting the library (wgm_resonator converts the
+        units of its parameters in place).
+        """
+        if self._entries is None:
+            self.reload()
+        assert data_type in paramSchema, ('Unknown data type {}, choose from '
+                                          '{}'.format(data_type,
+                                                      list(paramSchema)))
+        entries = self._entries[data_type]
+        if name not in entries:
+            if interactive is None:
+                interactive = self.interactive
+            if not interactive:
+                raise KeyError('There is no {} called {} in {}'.format(
+                    data_type, name, self.directory))
+            entries[name] = self._ask(name, data_type)
+        if isinstance(entries[name], Exception):
+            raise entries[name]
+        return dict(entries[name])
+
+    def _ask(self, name, data_type):
+        """
+        This asks for the values of a new parameter set at the command line,
+        saves it to the library's directory and returns it.
+        """
+        struct = {}
+        for key, units in paramSchema[data_type].items():
+            label = '{} ({})'.format(key, units) if units else key
+            struct[key] = input("Enter the {} for {}:".format(label, name))
+        struct = validateStruct(struct, data_type, name)
+        struct2txt(struct, os.path.join(self.directory, data_type,
+                                        name + '.txt'))
+        return struct
+
+_libraries = {}
+
+def getLibrary(directory=defaultParamDir, interactive=None):
+    """
+    This function returns the paramLibrary for directory, which is created
+    once per process (relative directories are taken from the current
+    working directory). If interactive is given, the library is switched to
+    that mode.
+    """
+    key = os.path.abspath(directory)
+    if key not in _libraries:
+        _libraries[key] = paramLibrary(key)
+    if interactive is not None:
+        _libraries[key].interactive = interactive
+    return _libraries[key]
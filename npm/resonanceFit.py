@@ -0,0 +1,220 @@
+"""
+This file has the analysis of resonator transmission traces: the resonance
+dips are found in whole batches of traces at once, Lorentzian (or split
+doublet) lineshapes are fitted to all of them together with a vectorized
+Levenberg-Marquardt solver, and the fitted linewidths are turned into
+Q-factors with Q_calculator.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .resonatorCalculator import Q_calculator
+
+
+def findDips(traces, threshold=0.5, minSeparation=50, maxDips=1, snr=6):
+    """
+    This function finds the transmission dips of a (traces, samples) array,
+    i.e. the local minima that are the lowest point within minSeparation
+    samples either side, at least threshold times as deep (below the
+    trace's median) as the deepest dip of that trace and at least snr times
+    the trace's noise, estimated from the median absolute deviation, so a
+    trace of noise alone has no dips. Returns a (traces, maxDips) array of
+    the sample indices of the deepest dips, padded with -1 where a trace has
+    fewer.
+    """
+    traces = np.atleast_2d(traces)
+    baseline = np.median(traces, axis=1, keepdims=True)
+    depth = baseline - traces
+    noise = 1.4826*np.median(abs(depth), axis=1, keepdims=True)
+    padded = np.pad(traces, ((0, 0), (minSeparation, minSeparation)),
+                    mode='edge')
+    localMin = sliding_window_view(padded, 2*minSeparation + 1,
+                                   axis=1).min(axis=-1)
+    candidate = ((traces == localMin) &
+                 (depth >= threshold*depth.max(axis=1, keepdims=True)) &
+                 (depth > snr*noise) & (depth > 0))
+    # Keep the first sample of flat-bottomed minima
+    candidate[:, 1:] &= traces[:, 1:] != traces[:, :-1]
+    score = np.where(candidate, depth, -np.inf)
+    order = np.argsort(-score, axis=1, kind='stable')[:, :maxDips]
+    found = np.take_along_axis(score, order, axis=1) > -np.inf
+    return np.where(found, order, -1)
+
+def _lorentzian(p, x):
+    """
+    This function returns the dip B - A/(1 + ((x - x0)/g)^2) for the
+    parameters p = (B, A, x0, g) of each row, with its Jacobian.
+    """
+    B, A, x0, g = [q[:, np.newaxis] for q in p.T]
+    u = (x - x0)/g
+    L = 1/(1 + u**2)
+    f = B - A*L
+    J = np.stack([np.ones_like(x), -L, -2*A*u*L**2/g, -2*A*u**2*L**2/g],
+                 axis=-1)
+    return f, J
+
+def _doublet(p, x):
+    """
+    This function returns the split doublet of two dips with a shared width,
+    B - A1 L(x - x1) - A2 L(x - x2), for the parameters
+    p = (B, A1, x1, A2, x2, g) of each row, with its Jacobian.
+    """
+    B, A1, x1, A2, x2, g = [q[:, np.newaxis] for q in p.T]
+    u1 = (x - x1)/g
+    u2 = (x - x2)/g
+    L1 = 1/(1 + u1**2)
+    L2 = 1/(1 + u2**2)
+    f = B - A1*L1 - A2*L2
+    J = np.stack([np.ones_like(x), -L1, -2*A1*u1*L1**2/g, -L2,
+                  -2*A2*u2*L2**2/g,
+                  -2*(A1*u1**2*L1**2 + A2*u2**2*L2**2)/g], axis=-1)
+    return f, J
+
+lineshapes = {'lorentzian':_lorentzian,
+              'doublet':_doublet}
+
+def levenbergMarquardt(model, p, x, y, maxIter=200, tol=1e-10):
+    """
+    This function fits model(p, x), which returns the model and its
+    Jacobian for every row, to the rows of y by least squares, running a
+    Levenberg-Marquardt iteration on all rows at once with a damping factor
+    per row. Rows are dropped from the working set once they have
+    converged, or once their damping has grown past 1e10 without finding a
+    better step, which counts as not converged. Returns the fitted
+    (rows, parameters) array, the sum of squared residuals and a mask of the
+    rows that converged.
+    """
+    p = np.array(p, dtype=float)
+    rows, nParams = p.shape
+    f, J = model(p, x)
+    cost = ((y - f)**2).sum(axis=1)
+    converged = np.zeros(rows, dtype=bool)
+    eye = np.eye(nParams)
+    # Working set of the rows that have not converged yet
+    index = np.arange(rows)
+    pW, xW, yW, fW, costW = p, x, y, f, cost.copy()
+    damping = np.full(rows, 1e-3)
+    for _ in range(maxIter):
+        JT = J.transpose(0, 2, 1)
+        A = JT @ J
+        g = JT @ (yW - fW)[:, :, np.newaxis]
+        diag = np.einsum('kii->ki', A)[:, :, np.newaxis]*eye
+        step = np.linalg.solve(A + damping[:, np.newaxis, np.newaxis]*diag +
+                               1e-12*eye, g)[:, :, 0]
+        pNew = pW + step
+        fNew, JNew = model(pNew, xW)
+        costNew = ((yW - fNew)**2).sum(axis=1)
+        better = (costNew <= costW) & np.isfinite(costNew)
+        small = (abs(step) <= tol*(abs(pW) + tol)).all(axis=1)
+        finished = better & small
+        stalled = ~better & (damping > 1e10)
+        pW = np.where(better[:, np.newaxis], pNew, pW)
+        fW = np.where(better[:, np.newaxis], fNew, fW)
+        J = np.where(better[:, np.newaxis, np.newaxis], JNew, J)
+        costW = np.where(better, costNew, costW)
+        damping = np.where(better, damping/10, damping*10)
+        p[index] = pW
+        cost[index] = costW
+        converged[index[finished]] = True
+        keep = ~(finished | stalled)
+        if not keep.any():
+            break
+        index, pW, xW, yW = index[keep], pW[keep], xW[keep], yW[keep]
+        fW, J, costW, damping = fW[keep], J[keep], costW[keep], damping[keep]
+    return p, cost, converged
+
+def _initialGuess(x, y, model):
+    """
+    This function estimates the dip parameters of each row from its edges,
+    minimum and the width of the part below half depth.
+    """
+    edge = max(1, x.shape[1]//10)
+    B = np.median(np.concatenate([y[:, :edge], y[:, -edge:]], axis=1), axis=1)
+    iMin = y.argmin(axis=1)
+    A = B - y[np.arange(len(y)), iMin]
+    x0 = x[np.arange(len(y)), iMin]
+    dx = np.ptp(x, axis=1)/(x.shape[1] - 1)
+    below = (y < (B - A/2)[:, np.newaxis]).sum(axis=1)
+    g = np.maximum(below, 2)*dx/2
+    if model == 'lorentzian':
+        return np.stack([B, A, x0, g], axis=1)
+    return np.stack([B, A/2, x0 - g/2, A/2, x0 + g/2, g/2], axis=1)
+
+def fitResonances(time, traces, scanScale=1, lam=1.55, model='lorentzian',
+                  window=None, threshold=0.5, minSeparation=50, maxDips=1,
+                  snr=6):
+    """
+    This function finds the transmission dips of many traces and fits a
+    lineshape to each of them, all at once. traces may be one trace, a
+    (traces, samples) array, or the channels dictionary of
+    oscilloscopeReader; time is the matching x axis (one row for all
+    traces, or one row per trace). model is 'lorentzian', or 'doublet' for
+    split resonances (two dips of equal width). Each fit uses the window
+    samples around its dip (by default eight times the widest dip).
+    The fitted full width at half maximum, in units of the x axis, is
+    converted to a linewidth with scanScale (MHz per x unit, as in
+    Q_calculator) and then to a Q-factor at the wavelength lam (um).
+    Dips must be snr times deeper than the trace's noise (see findDips), and
+    fits whose width collapses below a tenth of a sample or that stall are
+    not converged and have a NaN Q.
+    Returns a dictionary of (traces, maxDips) arrays (NaN where there is no
+    dip): the sample 'index' of each dip (-1 where there is none), its
+    'center', 'fwhm', 'depth', 'baseline', 'splitting' (doublets only), 'Q',
+    sum of squared 'residual's and whether the fit 'converged'.
+    """
+    assert model in lineshapes, ('Unknown model {}, choose from '
+                                 '{}'.format(model, list(lineshapes)))
+    if isinstance(traces, dict):
+        traces = np.array(list(traces.values()))
+    traces = np.atleast_2d(np.asarray(traces, dtype=float))
+    time = np.broadcast_to(np.atleast_2d(np.asarray(time, dtype=float)),
+                           traces.shape)
+    nTraces, samples = traces.shape
+    dips = findDips(traces, threshold, minSeparation, maxDips, snr)
+    trace, slot = np.nonzero(dips >= 0)
+    centre = dips[trace, slot]
+    if window is None:
+        # Only the traces with dips, as noise alone has no meaningful width
+        withDips = traces[np.unique(trace)]
+        depth = np.median(withDips, axis=1, keepdims=True) - withDips
+        half = depth >= depth.max(axis=1, keepdims=True)/2
+        window = int(np.clip(8*half.sum(axis=1).max(initial=0) /
+                             max(1, maxDips), 16, samples))
+    index = np.clip(centre[:, np.newaxis] - window//2 + np.arange(window), 0,
+                    samples - 1)
+    x = time[trace[:, np.newaxis], index]
+    y = traces[trace[:, np.newaxis], index]
+    # Fit in coordinates scaled to the window so every parameter is O(1)
+    offset = x.mean(axis=1, keepdims=True)
+    scale = np.ptp(x, axis=1, keepdims=True)
+    scale[scale == 0] = 1
+    xs = (x - offset)/scale
+    p0 = _initialGuess(xs, y, model)
+    p, cost, converged = levenbergMarquardt(lineshapes[model], p0, xs, y)
+    offset = offset[:, 0]
+    scale = scale[:, 0]
+    results = {key:np.full((nTraces, maxDips), np.nan)
+               for key in ['center', 'fwhm', 'depth', 'baseline',
+                           'splitting', 'Q', 'residual']}
+    results['index'] = dips
+    results['converged'] = np.zeros((nTraces, maxDips), dtype=bool)
+    fwhm = 2*abs(p[:, -1])*scale
+    # A width far below the sample spacing is a fit to a single sample
+    converged &= fwhm > 0.1*scale/(window - 1)
+    if model == 'lorentzian':
+        centers = offset + p[:, 2]*scale
+        depths = p[:, 1]
+    else:
+        centers = offset + (p[:, 2] + p[:, 4])/2*scale
+        depths = np.maximum(p[:, 1], p[:, 3])
+        results['splitting'][trace, slot] = abs(p[:, 4] - p[:, 2])*scale
+    results['center'][trace, slot] = centers
+    results['fwhm'][trace, slot] = fwhm
+    results['depth'][trace, slot] = depths
+    results['baseline'][trace, slot] = p[:, 0]
+    results['residual'][trace, slot] = cost
+    results['converged'][trace, slot] = converged
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Q = Q_calculator(lam=lam, scanScale=scanScale,
+                         FWHM=results['fwhm']).Q
+    results['Q'] = np.where(results['converged'], Q, np.nan)
+    return results
@@ -0,0 +1,157 @@
+"""
+This file has the code for keeping the results of long simulation scans on
+disk as they are produced, so an interrupted scan can carry on from the last
+completed point and the results can be analysed without loading them into
+memory.
+"""
+import os
+import json
+import numpy as np
+from .txtsave import _writeJson
+
+scanRecords = ['steps', 'nfev', 'wallTime', 'residual']
+scanColumns = ['Delta', 'pwr1', 'pwr2', 'e1_real', 'e1_imag', 'e2_real',
+               'e2_imag'] + scanRecords
+
+class resultStore:
+    """
+    This object stores the rows of a scan in a directory holding a
+    memory-mapped .npy array of shape (N, len(columns)), preallocated with
+    NaN, a done.npy mask of the rows written so far and a meta.json file
+    with the metadata of the run and the number of rows completed, i.e. the
+    length of the run of done rows at the start. Rows are appended in order
+    (append, write) or put at any row in any order (put, for scans whose
+    points finish out of order), and written to disk in chunks. Opening a
+    directory that already holds a store resumes it, as long as the metadata
+    matches the run being stored.
+    """
+    def __init__(self, directory, N=None, metadata=None, columns=scanColumns,
+                 chunk=100):
+        self.directory = directory
+        self.metaFile = os.path.join(directory, 'meta.json')
+        self.dataFile = os.path.join(directory, 'data.npy')
+        self.doneFile = os.path.join(directory, 'done.npy')
+        self.chunk = chunk
+        self._buffer = []
+        self._scattered = []
+        # Round trip the metadata through JSON so it compares like for like
+        metadata = json.loads(json.dumps(metadata))
+        if os.path.exists(self.metaFile):
+            with open(self.metaFile, 'r') as f:
+                self.meta = json.load(f)
+            if metadata is not None and metadata != self.meta['metadata']:
+                raise ValueError('{} holds the results of a different '
+                                 'run'.format(directory))
+            self.data = np.lib.format.open_memmap(self.dataFile, mode='r+')
+            if os.path.exists(self.doneFile):
+                self.done = np.lib.format.open_memmap(self.doneFile, mode='r+')
+            else:
+                # Stores written before the mask had in order rows only
+                self.done = np.lib.format.open_memmap(
+                    self.doneFile, mode='w+', dtype=bool,
+                    shape=(len(self.data),))
+                self.done[:self.meta['completed']] = True
+                self.done.flush()
+        else:
+            assert N is not None, 'The number of rows is needed for a new store'
+            os.makedirs(directory, exist_ok=True)
+            self.data = np.lib.format.open_memmap(self.dataFile, mode='w+',
+                                                  shape=(N, len(columns)))
+            self.data[:] = np.nan
+            self.data.flush()
+            self.done = np.lib.format.open_memmap(self.doneFile, mode='w+',
+                                                  dtype=bool, shape=(N,))
+            self.done.flush()
+            self.meta = {'columns':list(columns),
+                         'completed':0,
+                         'metadata':metadata}
+            _writeJson(self.meta, self.metaFile)
+        self.columns = self.meta['columns']
+
+    @property
+    def completed(self):
+        return self.meta['completed'] + len(self._buffer)
+
+    def append(self, row):
+        """
+        This adds the next row of the scan, writing it to disk once a whole
+        chunk of rows has been collected.
+        """
+        self._buffer.append(row)
+        if len(self._buffer) >= self.chunk:
+            self.flush()
+
+    def write(self, rows):
+        """
+        This adds a block of rows after the completed ones and writes them to
+        disk straight away.
+        """
+        self._buffer.extend(rows)
+        self.flush()
+
+    def put(self, index, rows):
+        """
+        This stores rows at the row numbers index, in any order, writing
+        them to disk once a whole chunk of rows has been collected.
+        """
+        self._scattered.append((np.asarray(index), np.asarray(rows)))
+        if sum(len(i) for i, _ in self._scattered) >= self.chunk:
+            self.flush()
+
+    def remaining(self):
+        """
+        This returns the row numbers that have not been stored yet.
+        """
+        done = self.done.copy()
+        done[self.meta['completed']:self.completed] = True
+        for index, _ in self._scattered:
+            done[index] = True
+        return np.flatnonzero(~done)
+
+    def flush(self):
+        """
+        This writes the buffered rows to disk and only then records them as
+        done, so the store stays consistent if the run is interrupted.
+        """
+        if not self._buffer and not self._scattered:
+            return
+        start = self.meta['completed']
+        index = [np.arange(start, start + len(self._buffer))]
+        if self._buffer:
+            self.data[start:start+len(self._buffer)] = self._buffer
+        for rowIndex, rows in self._scattered:
+            self.data[rowIndex] = rows
+            index.append(rowIndex)
+        self.data.flush()
+        self.done[np.concatenate(index)] = True
+        self.done.flush()
+        self._buffer = []
+        self._scattered = []
+        notDone = np.flatnonzero(~self.done)
+        self.meta['completed'] = int(notDone[0]) if len(notDone) else \
+            len(self.done)
+        _writeJson(self.meta, self.metaFile)
+
+    def column(self, name):
+        """
+        This returns a view of one column over the completed rows.
+        """
+        return self.data[:self.meta['completed'], self.columns.index(name)]
+
+def openResults(directory):
+    """
+    This function opens a stored scan for analysis, returning a read-only
+    memory-mapped view of the completed rows (nothing is read into memory
+    until it is used) with the store's column names and metadata. If rows
+    beyond the completed ones have been stored out of order, every stored
+    row is returned instead, which is a copy.
+    """
+    with open(os.path.join(directory, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    data = np.load(os.path.join(directory, 'data.npy'), mmap_mode='r')
+    doneFile = os.path.join(directory, 'done.npy')
+    if os.path.exists(doneFile):
+        done = np.load(doneFile, mmap_mode='r')
+        if done[meta['completed']:].any():
+            return np.asarray(data[done]), meta['columns'], meta['metadata']
+    return data[:meta['completed']], meta['columns'], meta['metadata']
@@ -0,0 +1,165 @@
+"""
+This file has the on-disk cache for the results of wgm_resonator simulations,
+so that scans repeated with the same material, resonator parameters, input
+powers and settings are looked up rather than integrated again. Results are
+addressed by a hash of their normalized parameters, and the least recently
+used results are removed once the cache grows past its size limit.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from .txtsave import _atomicWrite
+
+defaultCacheDir = os.path.join(os.path.expanduser('~'), '.npm_cache')
+
+def _normalize(value, digits=12):
+    """
+    This function turns value into plain JSON types with every float rounded
+    to the given number of significant digits, so that parameters which only
+    differ by round-off (or by being numpy rather than python numbers) hash
+    to the same key.
+    """
+    if isinstance(value, dict):
+        return {str(k):_normalize(v, digits) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_normalize(v, digits) for v in value]
+    if isinstance(value, (bool, np.bool_)) or value is None:
+        return None if value is None else bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float('{:.{}g}'.format(value, digits))
+    return str(value)
+
+def _detuningKeys(detunings):
+    """
+    This function rounds the detunings so the same point of two different
+    grids (e.g. a scan and a sub-range of it) is recognised as one point.
+    """
+    return np.round(np.asarray(detunings, dtype=float), 9)
+
+class simCache:
+    """
+    This object is a directory of cached simulation results, one .npz file
+    per key. Loading a result marks it as recently used (through its file
+    modification time) and saving one evicts the least recently used files
+    until the directory holds at most maxBytes.
+    """
+    def __init__(self, directory=defaultCacheDir, maxBytes=2**30):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, **parts):
+        """
+        This returns the key for a result, the SHA-256 hash of its normalized
+        parameters.
+        """
+        text = json.dumps(_normalize(parts), sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """
+        This returns the dictionary of arrays stored under key, or None if
+        there is none.
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as f:
+                arrays = dict(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(filename)
+        return arrays
+
+    def save(self, key, **arrays):
+        """
+        This stores the arrays under key, writing them to a temporary file
+        that is renamed into place so a result is never left half written.
+        """
+        with _atomicWrite(self._filename(key), 'wb') as f:
+            np.savez(f, **arrays)
+        self.evict()
+
+    def evict(self):
+        """
+        This removes the least recently used results until the cache is no
+        larger than maxBytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self):
+        """
+        This removes every result from the cache.
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.directory, name))
+
+    def pointwise(self, key, detunings, compute):
+        """
+        This returns the per-detuning results for detunings, where the result
+        at each detuning does not depend on the others (batch scans and
+        steady states). Detunings already in the entry for key are read from
+        it and only the missing ones are passed to compute, which returns a
+        dictionary of arrays whose first axis runs over the detunings it was
+        given. The new points are merged into the entry, padding any second
+        axis of different length with NaN.
+        Returns the dictionary of results ordered as detunings.
+        """
+        wanted = _detuningKeys(detunings)
+        cached = self.load(key)
+        if cached is None:
+            missing = np.ones(len(wanted), dtype=bool)
+        else:
+            missing = ~np.isin(wanted, cached['Delta'])
+        if missing.any():
+            new = compute(np.asarray(detunings)[missing])
+            new['Delta'] = wanted[missing]
+            if cached is not None:
+                new = {name:_concatenate(cached[name], new[name])
+                       for name in new}
+            order = np.argsort(new['Delta'])
+            cached = {name:value[order] for name, value in new.items()}
+            self.save(key, **cached)
+        index = np.searchsorted(cached['Delta'], wanted)
+        return {name:value[index] for name, value in cached.items()}
+
+def _concatenate(a, b):
+    """
+    This function joins two result arrays along their first axis, padding
+    the second axis of the narrower one with NaN if they differ.
+    """
+    if a.ndim > 1 and a.shape[1] != b.shape[1]:
+        width = max(a.shape[1], b.shape[1])
+        a, b = [np.pad(x, ((0, 0), (0, width - x.shape[1])),
+                       constant_values=np.nan) for x in (a, b)]
+    return np.concatenate([a, b])
+
+def getCache(cache):
+    """
+    This function returns the simCache for the cache argument of the
+    simulations: None for no caching, True for the default directory, a
+    directory name, or a simCache that has already been created.
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return simCache()
+    if isinstance(cache, str):
+        return simCache(cache)
+    return cache
@@ -0,0 +1,153 @@
+"""
+This file has the linear stability analysis of the wgm_resonator steady
+states. The eigenvalues of the analytic Jacobian of the four real field
+equations are found for whole arrays of states at once, so every point of a
+scan or branch can be labelled stable or unstable, and the bifurcations
+between neighbouring points classified, without any time integration.
+"""
+import numpy as np
+from .wgm_resonator import _fieldJacobian, _steadyStateResidual
+
+
+def fieldsFromIntensities(I1, I2, p1, p2, Delta):
+    """
+    This function returns the steady state fields e1 and e2 for the
+    intensities I1 = |e1|^2 and I2 = |e2|^2 at detuning Delta, found by
+    setting e_dot = 0 in the field equations.
+    """
+    with np.errstate(invalid='ignore'):
+        e1 = np.sqrt(p1)/(1 + 1.0j*(I1 + 2*I2 - Delta))
+        e2 = np.sqrt(p2)/(1 + 1.0j*(I2 + 2*I1 - Delta))
+    return e1, e2
+
+def stateStability(e1, e2, Delta1, Delta2=None, tol=1e-9):
+    """
+    This function finds the eigenvalues of the Jacobian at the steady states
+    (e1, e2), which may be broadcastable arrays of any shape (NaN entries,
+    such as the padding of steadyStates, give NaN eigenvalues). A state is
+    stable when every eigenvalue has a real part below -tol.
+    Returns the (..., 4) eigenvalues, sorted by decreasing real part, and
+    the boolean array of stable states.
+    """
+    if Delta2 is None:
+        Delta2 = Delta1
+    J = _fieldJacobian(e1, e2, Delta1, Delta2)
+    valid = np.isfinite(J).all(axis=(-2, -1))
+    eigenvalues = np.full(J.shape[:-1], np.nan + 0.0j)
+    eigenvalues[valid] = np.linalg.eigvals(J[valid])
+    order = np.argsort(-eigenvalues.real, axis=-1)
+    eigenvalues = np.take_along_axis(eigenvalues, order, axis=-1)
+    stable = valid & (eigenvalues[..., 0].real < -tol)
+    return eigenvalues, stable
+
+def _continuous(e1, e2, Delta, index, jumpTol=1e-2, maxIter=20):
+    """
+    This function checks whether the states at index and index + 1 lie on
+    the same branch, by continuing the intensities of the first to the
+    detuning of the second with Newton's method (the input powers are those
+    of the states, p = |e|^2 (1 + x^2)) and testing whether that lands on
+    the second within jumpTol (relative to 1 + I). Past a fold, or between
+    the states of a batch scan that settled on different branches, it does
+    not.
+    """
+    I1, I2 = abs(e1)**2, abs(e2)**2
+    x1 = I1 + 2*I2 - Delta
+    x2 = I2 + 2*I1 - Delta
+    p1 = (I1*(1 + x1**2))[index]
+    p2 = (I2*(1 + x2**2))[index]
+    y1, y2 = I1[index], I2[index]
+    target = Delta[index + 1]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(maxIter):
+            F1, F2, (J11, J12, J21, J22) = _steadyStateResidual(y1, y2, p1, p2,
+                                                                target)
+            det = J11*J22 - J12*J21
+            y1 = y1 - (J22*F1 - J12*F2)/det
+            y2 = y2 - (J11*F2 - J21*F1)/det
+        return ((abs(y1 - I1[index + 1]) <= jumpTol*(1 + I1[index + 1])) &
+                (abs(y2 - I2[index + 1]) <= jumpTol*(1 + I2[index + 1])))
+
+def classifyBifurcations(e1, e2, Delta, eigenvalues, tol=1e-9,
+                         checkJumps=True):
+    """
+    This function finds the bifurcations along an ordered sequence of states
+    (the points of a scan or of a continuation branch) from their
+    eigenvalues, found with stateStability. A bifurcation lies between two
+    neighbouring points on the same branch (checked with _continuous unless
+    checkJumps is False, as for continuation branches, so a jump between
+    branches, as in a batch scan, is not one) where the number of
+    eigenvalues with positive real part changes. The crossing eigenvalue is
+    the one with the largest real part on the unstable side, matched to the
+    nearest eigenvalue on the stable side (eigenvalues may collide between
+    the points, so the one nearest the imaginary axis need not be the one
+    crossing), and there must be a change of sign in its real part. It is a
+    'hopf' bifurcation if it is complex and two eigenvalues cross, a
+    'pitchfork' (symmetry breaking) if it is real and its eigenvector swaps
+    sign when e1 and e2 are exchanged at a symmetric state, and a 'fold'
+    otherwise.
+    Returns a dictionary of the index k of each bifurcation (it lies between
+    points k and k+1), its type, its detuning interpolated to where the
+    crossing eigenvalue's real part is zero (always between the two
+    points), and that eigenvalue (real for folds and pitchforks).
+    """
+    e1 = np.asarray(e1)
+    e2 = np.asarray(e2)
+    Delta = np.asarray(Delta, dtype=float)
+    growth = eigenvalues.real
+    nUnstable = (growth > tol).sum(axis=-1)
+    valid = ~np.isnan(growth).any(axis=-1)
+    index = np.flatnonzero((np.diff(nUnstable) != 0) &
+                           valid[:-1] & valid[1:])
+    if checkJumps:
+        index = index[_continuous(e1, e2, Delta, index)]
+    unstable = np.where(nUnstable[index] > nUnstable[index + 1], index,
+                        index + 1)
+    crossing = eigenvalues[unstable, 0]
+    other = eigenvalues[2*index + 1 - unstable]
+    matched = other[np.arange(len(index)),
+                    np.argmin(abs(other - crossing[:, np.newaxis]), axis=-1)]
+    before = np.where(unstable == index, crossing, matched)
+    after = np.where(unstable == index, matched, crossing)
+    # Only an eigenvalue whose real part changes sign crosses
+    crosses = before.real*after.real <= 0
+    index, unstable, crossing = index[crosses], unstable[crosses], \
+        crossing[crosses]
+    before, after = before[crosses], after[crosses]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.clip(np.nan_to_num(before.real/(before.real - after.real)),
+                    0, 1)
+    eigenvalue = before + w*(after - before)
+    types = []
+    for i, (k, u, lam) in enumerate(zip(index, unstable, crossing)):
+        if (abs(lam.imag) > np.sqrt(tol) and
+                abs(nUnstable[k + 1] - nUnstable[k]) == 2):
+            types.append('hopf')
+            continue
+        types.append('fold')
+        eigenvalue[i] = eigenvalue[i].real
+        symmetric = abs(e1[u] - e2[u]) < np.sqrt(tol)*max(1, abs(e1[u]))
+        if symmetric:
+            J = _fieldJacobian(e1[u], e2[u], Delta[u], Delta[u])
+            values, vectors = np.linalg.eig(J)
+            v = vectors[:, np.argmin(abs(values - lam))]
+            if np.linalg.norm(v[:2] + v[2:]) < np.linalg.norm(v[:2] - v[2:]):
+                types[-1] = 'pitchfork'
+    return {'index':index,
+            'type':np.array(types, dtype=str),
+            'Delta':Delta[index] + w*(Delta[index + 1] - Delta[index]),
+            'eigenvalue':eigenvalue}
+
+def branchStability(branch, p1, p2, tol=1e-9):
+    """
+    This function labels every point of a continuation branch, an (n, 3)
+    array of (I1, I2, Delta) as returned by continueBranches, as stable or
+    unstable and classifies the bifurcations along it.
+    Returns the (n, 4) eigenvalues, the boolean stable array and the
+    dictionary of bifurcations (see classifyBifurcations).
+    """
+    I1, I2, Delta = np.asarray(branch, dtype=float).T
+    e1, e2 = fieldsFromIntensities(I1, I2, p1, p2, Delta)
+    eigenvalues, stable = stateStability(e1, e2, Delta, tol=tol)
+    return (eigenvalues, stable,
+            classifyBifurcations(e1, e2, Delta, eigenvalues, tol,
+                                 checkJumps=False))
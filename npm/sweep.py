@@ -0,0 +1,112 @@
+"""
+This file has the code for sweeping the wgm_resonator simulations over grids
+of input powers, detunings and material/resonator parameter sets, spreading
+the work across a pool of worker processes.
+"""
+import os
+import multiprocessing
+import numpy as np
+from .wgm_resonator import wgm_resonator, _load_struct
+
+sweepFields = {'batch':['pwr1', 'pwr2'],
+               'sequential':['pwr1', 'pwr2'],
+               'steady':['nStates', 'asymmetry']}
+
+def _initWorker():
+    """
+    This function runs once in each pool worker process so that nothing it
+    does can open a window. It is not run for processes=1, as it would
+    switch the caller's own matplotlib backend.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _sweepTask(task):
+    """
+    This function runs one (parameter set, p1, p2) point of a sweep over all
+    of its detunings and returns the task index with the result, an array of
+    shape (N, 2) holding the fields named in sweepFields for the method.
+    """
+    (index, material, resonator_params, p1, p2, Del0, Del1, N, method,
+     kwargs, seed) = task
+    sim = wgm_resonator(material=material, resonator_params=resonator_params)
+    if method == 'steady':
+        detunings, e1, e2 = sim.steadyStates(Del0, Del1, p1, p2, N)
+        nStates = (~np.isnan(e1)).sum(axis=1)
+        asymmetry = np.nanmax(abs(abs(e1)**2 - abs(e2)**2), axis=1)
+        return index, np.stack([nStates, asymmetry], axis=-1)
+    rng = np.random.default_rng(seed)
+    kwargs = dict({'progress':False}, **kwargs)
+    detunings, pwr1, pwr2 = sim.frequencyScan(Del0, Del1, p1, p2, N,
+                                              batch=(method == 'batch'),
+                                              plot=False, rng=rng, **kwargs)
+    return index, np.stack([pwr1, pwr2], axis=-1)
+
+def parameterSweep(p1, p2, Del0=-4, Del1=7, N=100, params=None,
+                   method='batch', processes=None, chunksize=None, seed=None,
+                   **kwargs):
+    """
+    This function maps the wgm_resonator response over every combination of
+    the input powers p1 and p2 (scalars or sequences) and the N detunings
+    from Del0 to Del1, for each of the (material, resonator_params) name
+    pairs in params. With no params, p1 and p2 are the normalised powers used
+    by frequencyScan; otherwise they are input powers in W, normalised by P0
+    of each parameter set.
+    The method is 'batch' or 'sequential' (a frequencyScan, giving |e1| and
+    |e2|) or 'steady' (steadyStates, giving the number of steady states and
+    their largest intensity asymmetry |I1 - I2|, i.e. a symmetry-breaking
+    map). Extra keyword arguments go to frequencyScan.
+    Each (parameter set, p1, p2) point is one task, scheduled in chunks
+    across a pool of processes (all cores by default, processes=1 runs in
+    this process). Workers never plot, show progress, read parameter files
+    or prompt for input, and each task has its own random stream spawned
+    from seed.
+    Returns a dictionary of the coordinate labels and the result array of
+    shape (len(params), len(p1), len(p2), N, 2).
+    """
+    assert method in sweepFields, ('Unknown method {}, choose from '
+                                   '{}'.format(method, list(sweepFields)))
+    p1 = np.atleast_1d(np.asarray(p1, dtype=float))
+    p2 = np.atleast_1d(np.asarray(p2, dtype=float))
+    if params is None:
+        params = [('fused-silica', 'symm_break_paper')]
+        P0 = [1.0]
+    else:
+        P0 = None
+    # Load the parameter sets here once, so the workers get plain structures
+    structs = [(_load_struct(material, data_type='material'),
+                _load_struct(resonator, data_type='resonator_params'))
+               for material, resonator in params]
+    if P0 is None:
+        P0 = [wgm_resonator(material=m,
+                            resonator_params=r).resonator_params['P0']
+              for m, r in structs]
+    shape = (len(params), len(p1), len(p2))
+    seeds = np.random.SeedSequence(seed).spawn(int(np.prod(shape)))
+    tasks = []
+    for index in np.ndindex(*shape):
+        k, i, j = index
+        tasks.append((index, structs[k][0], structs[k][1], p1[i]/P0[k],
+                      p2[j]/P0[k], Del0, Del1, N, method, kwargs,
+                      seeds[len(tasks)]))
+    result = np.zeros(shape + (N, 2))
+    if processes is None:
+        processes = os.cpu_count()
+    if processes == 1:
+        # Tasks never plot, so the caller's matplotlib backend is left alone
+        for index, value in map(_sweepTask, tasks):
+            result[index] = value
+    else:
+        if chunksize is None:
+            # A few chunks per worker balances the load without much overhead
+            chunksize = max(1, len(tasks)//(4*processes))
+        with multiprocessing.Pool(processes, initializer=_initWorker) as pool:
+            for index, value in pool.imap_unordered(_sweepTask, tasks,
+                                                    chunksize):
+                result[index] = value
+    coords = {'params':list(params),
+              'p1':p1,
+              'p2':p2,
+              'Delta':np.linspace(Del0, Del1, N),
+              'field':sweepFields[method]}
+    return coords, result
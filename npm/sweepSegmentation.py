@@ -0,0 +1,107 @@
+"""
+This file has the code for splitting oscilloscope captures of a laser swept
+back and forth by a triangle wave into its individual sweeps. The turning
+points are found from the ramp channel, and every forward and backward sweep
+of the other channels is resampled onto one common axis, so forward and
+backward sweeps can be compared directly (e.g. for hysteresis).
+"""
+import numpy as np
+
+
+def _smooth(y, width):
+    """
+    This function returns the moving average of y over width samples, with
+    the ends averaged over the samples available.
+    """
+    if width <= 1:
+        return np.asarray(y, dtype=float)
+    c = np.concatenate([[0], np.cumsum(y, dtype=float)])
+    n = len(y)
+    lo = np.clip(np.arange(n) - width//2, 0, n)
+    hi = np.clip(np.arange(n) + width - width//2, 0, n)
+    return (c[hi] - c[lo])/(hi - lo)
+
+def findTurningPoints(ramp, smooth=None, hysteresis=0.25):
+    """
+    This function finds the turning points of a triangle-wave ramp. The ramp
+    (smoothed over smooth samples, 0.1 % of its length by default) is split
+    into high and low regions, where it is within hysteresis times its range
+    of its maximum or minimum, so noise cannot produce extra turns; the
+    turning points are then the maximum of each high region and the minimum
+    of each low region. Regions that touch the start or end of the capture
+    may be cut short, so they give no turning point. Returns the sample
+    indices of the turning points.
+    """
+    if smooth is None:
+        smooth = max(1, len(ramp)//1000)
+    r = _smooth(ramp, smooth)
+    lo, hi = r.min(), r.max()
+    level = np.where(r >= hi - hysteresis*(hi - lo), 1,
+                     np.where(r <= lo + hysteresis*(hi - lo), -1, 0))
+    regions = np.flatnonzero(level)
+    if not len(regions):
+        return np.zeros(0, dtype=int)
+    level = level[regions]
+    # Start a new region wherever the level changes from high to low
+    region = np.cumsum(np.diff(level, prepend=0) != 0) - 1
+    # Sort by region, then by how extreme the ramp is within the region
+    order = np.lexsort((-level*r[regions], region))
+    first = np.searchsorted(region[order], np.arange(region[-1] + 1))
+    turns = regions[order[first]]
+    # Drop the regions that contain the first or last sample
+    edges = region[[0, -1]][(regions[[0, -1]] == [0, len(r) - 1])]
+    keep = ~np.isin(np.arange(region[-1] + 1), edges)
+    return np.sort(turns[keep])
+
+def segmentSweeps(time, channels, rampChannel, points=1000, axis=None,
+                  scanScale=1, smooth=None, hysteresis=0.25):
+    """
+    This function splits a capture of a triangle-wave laser scan, given as
+    the time and channels of oscilloscopeReader, into its sweeps between the
+    turning points of the ramp channel (see findTurningPoints); the partial
+    sweeps before the first and after the last turning point are dropped.
+    Every sweep of every other channel is averaged into points bins of the
+    ramp value, the common axis (or into the bins centred on the given axis,
+    in ramp units), with one bincount over the whole capture, so there is
+    no loop over samples or sweeps. Bins a sweep does not reach are NaN.
+    Returns a dictionary of the axis, the 'detuning' (scanScale times the
+    axis, e.g. MHz for scanScale in MHz per ramp unit), the start and stop
+    sample and time of each sweep, its direction (+1 forward, -1 backward)
+    and, for 'forward' and 'backward', dictionaries of the channels as
+    (sweeps, points) arrays.
+    """
+    ramp = np.asarray(channels[rampChannel], dtype=float)
+    turns = findTurningPoints(ramp, smooth, hysteresis)
+    start, stop = turns[:-1], turns[1:]
+    direction = np.sign(ramp[stop] - ramp[start]).astype(int)
+    if axis is None:
+        axis = np.linspace(ramp.min(), ramp.max(), points)
+    axis = np.asarray(axis, dtype=float)
+    edges = np.concatenate([[-np.inf], (axis[1:] + axis[:-1])/2, [np.inf]])
+    bins = np.searchsorted(edges, ramp, side='right') - 1
+    # Sweep of every sample, of which only those in complete sweeps are kept
+    samples = np.arange(len(ramp))
+    sweep = np.searchsorted(stop, samples, side='left')
+    inside = (sweep < len(stop)) & (samples >= turns[:1].sum())
+    key = sweep[inside]*len(axis) + bins[inside]
+    size = len(stop)*len(axis)
+    counts = np.bincount(key, minlength=size)
+    result = {'axis':axis,
+              'detuning':scanScale*axis,
+              'start':start,
+              'stop':stop,
+              'startTime':np.asarray(time)[start],
+              'stopTime':np.asarray(time)[stop],
+              'direction':direction,
+              'forward':{},
+              'backward':{}}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, values in channels.items():
+            if name == rampChannel:
+                continue
+            sums = np.bincount(key, weights=np.asarray(values)[inside],
+                               minlength=size)
+            means = (sums/counts).reshape(len(stop), len(axis))
+            result['forward'][name] = means[direction > 0]
+            result['backward'][name] = means[direction < 0]
+    return result
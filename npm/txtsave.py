@@ -1,44 +1,336 @@
 """
 This file has all the code required for saving/loading the parameters of a txt
-file from/to a python structure for subsequent use
+file from/to a python structure for subsequent use. Each value is written on
+a line 'key [type]: value' so it is read back with its type, and NumPy arrays
+are written to a binary sidecar file, named in the text file, that is read
+back through memory mapping. Every save writes a new sidecar and then
+renames the text file into place, so the pair is replaced at once and a
+reader never sees a half-written file or mismatched files.
 """
+import os
+import json
+import time
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+_align = 64 # Byte alignment of the arrays in a sidecar file
+_indexTag = '# index: ' # First line of a structs2txt file
+_staleAge = 60 # Age (s) after which an unreferenced sidecar is removed
+
+def _makeDirectory(filename):
+    """
+    This function creates the directory of filename if it does not exist.
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+@contextmanager
+def _atomicWrite(filename, mode='w'):
+    """
+    This context manager opens a uniquely named temporary file next to
+    filename and renames it into place once the block has finished, so
+    processes writing the same file at once never share a temporary file and
+    a reader only ever sees a complete file. The temporary file is removed
+    if the block fails.
+    """
+    tmp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+    try:
+        # Exclusive creation, with the permissions of any new file
+        with open(tmp, mode.replace('w', 'x')) as f:
+            yield f
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _writeJson(struct, filename):
+    """
+    This function writes struct to filename as JSON through a temporary file
+    that is renamed into place, so the file is never left half written.
+    """
+    with _atomicWrite(filename) as f:
+        json.dump(struct, f, indent=1)
+
+def _formatValue(value):
+    """
+    This function returns the type name and text of a single value, or the
+    type 'array' and None for arrays, which go in the sidecar.
+    """
+    if isinstance(value, np.ndarray):
+        assert value.dtype != object, 'Object arrays cannot be saved'
+        return 'array', None
+    if value is None:
+        return 'none', ''
+    if isinstance(value, (bool, np.bool_)):
+        return 'bool', str(bool(value))
+    if isinstance(value, (int, np.integer)):
+        return 'int', str(int(value))
+    if isinstance(value, (float, np.floating)):
+        return 'float', repr(float(value))
+    if isinstance(value, (complex, np.complexfloating)):
+        return 'complex', repr(complex(value))
+    if isinstance(value, str):
+        return 'str', json.dumps(value)
+    return 'json', json.dumps(value)
+
+def _parseValue(kind, text):
+    """
+    This function is the inverse of _formatValue for everything but arrays.
+    """
+    if kind == 'none':
+        return None
+    if kind == 'bool':
+        return text == 'True'
+    if kind == 'int':
+        return int(text)
+    if kind == 'float':
+        return float(text)
+    if kind == 'complex':
+        return complex(text)
+    if kind in ('str', 'json'):
+        return json.loads(text)
+    raise ValueError('Unknown type {}'.format(kind))
+
+def _formatLines(struct, arrays, offset, sidecar):
+    """
+    This function returns the lines for struct, appending its arrays to the
+    list of arrays for the sidecar file (a name in the text file's
+    directory), in which they start at byte offset. Returns the lines and
+    the offset after the arrays.
+    """
+    lines = []
+    for key, value in struct.items():
+        kind, text = _formatValue(value)
+        if kind == 'array':
+            value = np.require(value, requirements='C')
+            text = json.dumps({'dtype':value.dtype.str,
+                               'shape':list(value.shape),
+                               'offset':offset,
+                               'file':sidecar})
+            arrays.append((offset, value))
+            offset += -(-value.nbytes//_align)*_align
+        lines.append('{} [{}]: {}\n'.format(key, kind, text))
+    return lines, offset
+
+def _parseLine(line, filename, mmap):
+    """
+    This function returns the key and value of a line of the text file
+    filename. The line is split on its first colon only, so values may
+    contain colons, and lines written without a type (by older versions) are
+    read as strings, as are arrays without a sidecar name (from filename +
+    '.bin').
+    """
+    key, text = line.rstrip('\r\n').split(':', 1)
+    text = text[1:] if text.startswith(' ') else text
+    if key.endswith(']') and ' [' in key:
+        key, kind = key[:-1].rsplit(' [', 1)
+    else:
+        return key, text
+    if kind != 'array':
+        return key, _parseValue(kind, text)
+    spec = json.loads(text)
+    sidecar = _sidecarPath(filename, spec)
+    shape = tuple(spec['shape'])
+    dtype = np.dtype(spec['dtype'])
+    if mmap and np.prod(shape, dtype=int) > 0:
+        value = np.memmap(sidecar, dtype=dtype, mode='r',
+                          offset=spec['offset'], shape=shape)
+    else:
+        count = int(np.prod(shape, dtype=int))
+        with open(sidecar, 'rb') as f:
+            f.seek(spec['offset'])
+            value = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return key, value
+
+def _sidecarPath(filename, spec):
+    """
+    This function returns the path of the sidecar that holds the array spec
+    of the text file filename.
+    """
+    name = spec.get('file', os.path.basename(filename) + '.bin')
+    return os.path.join(os.path.dirname(filename), name)
+
+def _newSidecar(filename):
+    """
+    This function returns a new, unique sidecar name for filename.
+    """
+    return '{}.{}.bin'.format(os.path.basename(filename), uuid.uuid4().hex[:16])
+
+def _sidecars(filename):
+    """
+    This function returns the paths of the sidecars that the text file
+    filename refers to (none if it does not exist).
+    """
+    paths = set()
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                if ' [array]: ' in line:
+                    spec = json.loads(line.split(' [array]: ', 1)[1])
+                    paths.add(_sidecarPath(filename, spec))
+    except (OSError, ValueError):
+        pass
+    return paths
+
+def _writeFiles(filename, lines, arrays, sidecar):
+    """
+    This function writes the sidecar of arrays under its new unique name,
+    then the text file, through a temporary file renamed into place, which
+    is the one step that replaces the saved pair, and finally removes the
+    sidecars the replaced text file referred to. Processes saving the same
+    file at once each leave a consistent pair; the sidecars of the saves
+    that lost the race are removed by a later save once they are _staleAge
+    seconds old.
+    """
+    _makeDirectory(filename)
+    old = _sidecars(filename)
+    path = os.path.join(os.path.dirname(filename), sidecar)
+    if arrays:
+        with open(path, 'xb') as f:
+            for offset, value in arrays:
+                f.seek(offset)
+                f.write(value.reshape(-1).view(np.uint8))
+    with _atomicWrite(filename, 'wb') as f:
+        f.write(''.join(lines).encode('utf-8'))
+    # Never remove a sidecar the text file refers to now, which may be that
+    # of another process's save
+    current = _sidecars(filename)
+    prefix = os.path.basename(filename) + '.'
+    now = time.time()
+    for name in os.listdir(os.path.dirname(filename) or '.'):
+        i = os.path.join(os.path.dirname(filename), name)
+        if (i in current or not name.startswith(prefix) or
+                not name.endswith('.bin')):
+            continue
+        try:
+            if i in old or now - os.path.getmtime(i) > _staleAge:
+                os.remove(i)
+        except OSError:
+            pass
+
+def _retry(read, attempts=3):
+    """
+    This function calls read, again if a sidecar it opened was removed by a
+    save that replaced the file in the meantime.
+    """
+    for attempt in range(attempts):
+        try:
+            return read()
+        except FileNotFoundError:
+            if attempt == attempts - 1:
+                raise
 
 def struct2txt(struct,filename):
     """
     This function takes a python structure, struct, and saves its parameters
     in a txt file located at a position given by filename.
     Does include:
-        - automatic generation of directory, filename must be 
+        - automatic generation of directory, filename must be
           'dir1/dir2/file.txt'
-    Does NOT include:
-        - variable type saving
+        - variable type saving (None, bool, int, float, complex, str, and
+          lists/dicts of these as JSON)
+        - NumPy arrays, saved in a binary sidecar file next to it
+        - atomic writing (new sidecar, then text file temporary + rename)
     """
-    import os
-    import errno
-    
-    if not os.path.exists(os.path.dirname(filename)):
-        try:
-            os.makedirs(os.path.dirname(filename))
-        except OSError as exc: # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
-                
-    with open(filename, "w") as f:
-        for key, value in struct.items():
-            f.write("{}: {}\n".format(key,value))
-    
-def txt2struct(filename):
+    arrays = []
+    sidecar = _newSidecar(filename)
+    lines, _ = _formatLines(struct, arrays, 0, sidecar)
+    _writeFiles(filename, lines, arrays, sidecar)
+
+def txt2struct(filename, mmap=True):
+    """
+    This function takes a filename, and returns a structure of its
+    parameters with their saved types. Arrays are memory-mapped read-only
+    from the sidecar file (no copy is made until they are used), or read
+    into memory if mmap is False.
+    """
+    def read():
+        struct = {}
+        with open(filename,"r") as f:
+            for i in f:
+                if i.strip():
+                    key, val = _parseLine(i, filename, mmap)
+                    struct[key] = val
+        return struct
+    return _retry(read)
+
+def structs2txt(structs, filename):
     """
-    This function takes a filename, and returns a structure of 
-    Does NOT include:
-        - automatic setting of variable type
+    This function saves many structures at once, given as a dictionary of
+    name: struct, in one txt file with a section '[[name]]' per structure
+    and one sidecar file holding all of their arrays. The first line is an
+    index of the byte range of each section (after that line), so single
+    structures can be read without parsing the rest of the file.
     """
+    arrays = []
+    offset = 0
+    sections = []
+    sidecar = _newSidecar(filename)
+    for name, struct in structs.items():
+        assert '\n' not in name, 'Structure names cannot contain newlines'
+        structLines, offset = _formatLines(struct, arrays, offset, sidecar)
+        sections.append((name, ''.join(['[[{}]]\n'.format(name)] +
+                                       structLines)))
+    index = {}
+    start = 0
+    for name, text in sections:
+        size = len(text.encode('utf-8'))
+        index[name] = [start, start + size]
+        start += size
+    lines = [_indexTag + json.dumps(index) + '\n'] + [t for _, t in sections]
+    _writeFiles(filename, lines, arrays, sidecar)
+
+def _parseSection(text, filename, mmap):
+    """
+    This function returns the name and structure of the text of one
+    '[[name]]' section.
+    """
+    lines = text.splitlines()
     struct = {}
-    with open(filename,"r") as f:
-        for i in f:
-            key, val = i.split("\n")[0].split(":")
+    for i in lines[1:]:
+        if i.strip():
+            key, val = _parseLine(i, filename, mmap)
             struct[key] = val
-    return struct
+    return lines[0][2:-2], struct
+
+def txt2structs(filename, names=None, mmap=True):
+    """
+    This function loads the structures saved by structs2txt, returning a
+    dictionary of name: struct. If names is given, only those structures are
+    read, seeking straight to them through the index (files without an
+    index are scanned and the lines of the others skipped).
+    """
+    def read():
+        structs = {}
+        with open(filename, 'rb') as f:
+            first = f.readline().decode('utf-8')
+            if first.startswith(_indexTag):
+                index = json.loads(first[len(_indexTag):])
+                body = f.tell()
+                for name, (start, stop) in index.items():
+                    if names is None or name in names:
+                        f.seek(body + start)
+                        text = f.read(stop - start).decode('utf-8')
+                        structs[name] = _parseSection(text, filename,
+                                                      mmap)[1]
+                return structs
+            f.seek(0)
+            struct = None
+            for i in f:
+                i = i.decode('utf-8').rstrip('\r\n')
+                if i.startswith('[[') and i.endswith(']]'):
+                    name = i[2:-2]
+                    struct = None
+                    if names is None or name in names:
+                        struct = structs[name] = {}
+                elif struct is not None and i.strip():
+                    key, val = _parseLine(i, filename, mmap)
+                    struct[key] = val
+        return structs
+    return _retry(read)
 
 
 if __name__ =='__main__':
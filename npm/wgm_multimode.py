@@ -0,0 +1,163 @@
+"""
+This file has the code for the simulation of counter-propagating light in a
+whispering gallery mode resonator with many azimuthal modes per direction,
+so that Kerr frequency combs can form in both directions. Each direction is
+evolved with a split-step Fourier method for the Lugiato-Lefever equation,
+coupled to the other direction by the cross-phase of its mean power.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+from .wgm_resonator import wgm_resonator
+
+
+class wgm_multimode(wgm_resonator):
+    """
+    This object extends wgm_resonator to M azimuthal modes per direction. In
+    the same normalised units, the modes e_mu of each direction evolve as
+    e_dot = L_mu e + e_tilda delta_mu0 - i FFT[(|E|^2 + 2<|E_other|^2>) E]
+    where E(theta) is the field around the resonator, <> is its mean over
+    theta and L_mu = -1 + i(Delta + d2 mu^2/2), with d2 the second order
+    dispersion normalised to the resonance half-width gamma (d2 > 0 is
+    anomalous). The dispersion is given either as d2 or as the physical D2
+    (Hz, i.e. D2/2pi, with the mode frequencies f_mu = f_0 + mu*df_fsr +
+    D2*mu^2/2), which is normalised by gamma of the resonator parameters.
+    With M = 1 this is the two mode model of wgm_resonator.
+    The fields are kept as a (2, M) array of mode amplitudes in numpy's FFT
+    order (see modeNumbers).
+    """
+    def __init__(self,
+                 material = 'fused-silica',
+                 resonator_params = 'symm_break_paper',
+                 M = 256,
+                 d2 = 0.01,
+                 D2 = None):
+        super().__init__(material=material, resonator_params=resonator_params)
+        self.M = M
+        if D2 is not None:
+            d2 = D2/self.resonator_params['gamma']
+        self.d2 = d2
+        self.modeNumbers = np.rint(np.fft.fftfreq(M)*M)
+        self.modes = np.zeros((2, M), dtype=complex)
+
+    def frequencies(self):
+        """
+        This returns the frequency offset of each mode from the pumped mode,
+        mu*df_fsr, in the order of the mode amplitudes.
+        """
+        return self.modeNumbers*self.resonator_params['df_fsr']
+
+    def integratedDispersion(self):
+        """
+        This returns the offset of each mode's resonance from the equally
+        spaced grid mu*df_fsr in Hz, D2*mu^2/2 = gamma*d2*mu^2/2.
+        """
+        return self.resonator_params['gamma']*self.d2*self.modeNumbers**2/2
+
+    def normalisedPower(self, P):
+        """
+        This returns the normalised pump power used by evolve and combScan
+        for an input power P in W, P/P0 (as parameterSweep does).
+        """
+        return np.asarray(P)/self.resonator_params['P0']
+
+    def _linearStep(self, modes, Delta, pump, h):
+        """
+        This integrates the linear part of the equations (loss, detuning,
+        dispersion and pump) exactly over a time h in the mode basis.
+        """
+        L = -1 + 1.0j*(Delta + self.d2*self.modeNumbers**2/2)
+        propagator = np.exp(L*h)
+        modes = propagator*modes
+        modes[:, 0] += pump*(propagator[0] - 1)/L[0]
+        return modes
+
+    def _nonlinearStep(self, modes, h):
+        """
+        This integrates the self- and cross-phase modulation exactly over a
+        time h, in which |E| and so the phase shift are constant. The field
+        around the resonator is E = M*ifft(e), so that <|E|^2> = sum |e|^2.
+        """
+        field = self.M*np.fft.ifft(modes, axis=-1)
+        power = abs(field)**2
+        meanPower = power.mean(axis=-1, keepdims=True)
+        phase = power + 2*meanPower[::-1]
+        return np.fft.fft(field*np.exp(-1.0j*phase*h), axis=-1)/self.M
+
+    def evolve(self, Delta, p1=1.4, p2=1.4, T=100, dt=0.01, Noise=1e-9,
+               rng=None, record=100):
+        """
+        This evolves the modes of both directions for a time T at the
+        detuning Delta with the pump powers p1 and p2, using symmetric
+        (Strang) split steps of size dt. Noise adds complex white noise to
+        every mode at each step so that combs can start from the
+        homogeneous state. The cost of a step is O(M log M).
+        Returns the total power in each direction, sum |e_mu|^2, every
+        record steps as an (n, 2) array.
+        """
+        rng = np.random if rng is None else rng
+        pump = np.sqrt([p1, p2])
+        modes = self.modes
+        steps = int(round(T/dt))
+        powers = np.zeros((steps//record + 1, 2))
+        powers[0] = (abs(modes)**2).sum(axis=-1)
+        modes = self._linearStep(modes, Delta, pump, dt/2)
+        for n in range(1, steps + 1):
+            modes = self._nonlinearStep(modes, dt)
+            if Noise:
+                modes += Noise*(rng.normal(size=modes.shape) +
+                                1.0j*rng.normal(size=modes.shape))
+            # Join the second half step with the next first half step
+            h = dt if n < steps else dt/2
+            modes = self._linearStep(modes, Delta, pump, h)
+            if n % record == 0:
+                powers[n//record] = (abs(modes)**2).sum(axis=-1)
+        self.modes = modes
+        self.e1, self.e2 = modes[:, 0]
+        self.e1_tilda, self.e2_tilda = np.sqrt(p1), np.sqrt(p2)
+        self.Delta1 = self.Delta2 = Delta
+        return powers
+
+    def combScan(self, Del0=-4, Del1=7, p1=1.4, p2=1.4, N=10, T=100,
+                 dt=0.01, Noise=1e-9, rng=None, plot=True):
+        """
+        This scans the detuning from Del0 to Del1 in N steps, evolving the
+        modes for a time T at each detuning starting from the state reached
+        at the previous one (the usual way of generating a comb), and returns
+        the detunings with the square root of the total power in each
+        direction, which is |e1| and |e2| of frequencyScan for M = 1. The
+        spectra |e_mu|^2 at the end of each detuning are kept in
+        self.scanInfo['spectra'], an (N, 2, M) array, and the last one is
+        plotted if plot is True.
+        """
+        rng = np.random if rng is None else rng
+        self.modes = np.zeros((2, self.M), dtype=complex)
+        self.modes[:, 0] = 1.0 + 1.0j
+        detunings = np.linspace(Del0, Del1, N)
+        spectra = np.zeros((N, 2, self.M))
+        for index, det in enumerate(detunings):
+            self.evolve(det, p1, p2, T, dt, Noise, rng, record=int(T/dt))
+            spectra[index] = abs(self.modes)**2
+        pwr1, pwr2 = np.sqrt(spectra.sum(axis=-1)).T
+        self.scanInfo = {'spectra':spectra}
+        if plot:
+            plotSpectrum(self.modeNumbers, spectra[-1])
+        return detunings, pwr1, pwr2
+
+def plotSpectrum(modeNumbers, spectrum, ax=None):
+    """
+    This function plots the mode powers of both directions in dB against the
+    mode number, as a stem-like plot with one call per direction.
+    """
+    if ax is None:
+        ax = plt.figure().add_subplot(111)
+    order = np.argsort(modeNumbers)
+    mu = modeNumbers[order]
+    with np.errstate(divide='ignore'):
+        dB = 10*np.log10(spectrum[:, order])
+    floor = np.nanmin(dB[np.isfinite(dB)]) if np.isfinite(dB).any() else 0
+    for values, colour, label in zip(dB, 'rb', ['Forward', 'Backward']):
+        ax.vlines(mu, floor, values, colour, alpha=0.5, label=label)
+    ax.set_xlabel('Mode number')
+    ax.set_ylabel('Mode power (dB)')
+    ax.legend()
+    return ax
@@ -2,12 +2,16 @@
 This file has all the code required for the simulation of counter-propagating
 light in a whispering gallery mode resonator
 """
-import os
+import time
+from contextlib import nullcontext
 import numpy as np
 import matplotlib.pyplot as plt
-#from txtsave import *
-#from printProgressBar import *
 import npm
+from .paramLibrary import getLibrary
+from .integrators import getIntegrator, eulerIntegrator
+from .resultStore import resultStore, scanRecords
+from .instrumentation import progressReporter, scanProfiler
+from .simCache import getCache
 
 class wgm_resonator:
     """
@@ -19,10 +23,13 @@ class wgm_resonator:
     def __init__(self,
                  material = 'fused-silica',
                  resonator_params = 'symm_break_paper'):
-        # Load the material and resonator geometry properties
-        self.material = _load_struct(material,data_type = 'material')
-        self.resonator_params = _load_struct(resonator_params,
-                                             data_type = 'resonator_params')
+        # Load the material and resonator geometry properties, keeping the
+        # structures as loaded so they can be passed to another simulation
+        self.rawMaterial = _load_struct(material,data_type = 'material')
+        self.rawResonatorParams = _load_struct(resonator_params,
+                                               data_type = 'resonator_params')
+        self.material = dict(self.rawMaterial)
+        self.resonator_params = dict(self.rawResonatorParams)
         self.update_resonator_params()
         # Initialise fields
         self.e1 = 0.0 + 0.0j
@@ -54,18 +61,368 @@ class wgm_resonator:
         self.resonator_params['gamma'] = gamma
         self.resonator_params['F0'] = F0
         self.resonator_params['P0'] = P0
+        # Mark the structures as converted, so they are not converted again
+        self.material = _convertedStruct(self.material)
+        self.resonator_params = _convertedStruct(self.resonator_params)
     
     def _getFieldDerivatives(self):
-        e1_dot = self.e1_tilda - (1 + 0+1.0j*(abs(self.e1)**2 + 
-                                              2*abs(self.e2)**2
-                                          - self.Delta1))*self.e1
-        e2_dot = self.e2_tilda - (1 + 0+1.0j*(abs(self.e2)**2 + 
-                                              2*abs(self.e1)**2 
-                                          - self.Delta2))*self.e2
-        self.e1_dot, self.e2_dot = e1_dot, e2_dot
+        self.e1_dot, self.e2_dot = _fieldDerivatives(self.e1, self.e2,
+                                                     self.e1_tilda,
+                                                     self.e2_tilda,
+                                                     self.Delta1,
+                                                     self.Delta2)
         
+    def _relax(self, e1, e2, Delta, integrator, Noise, dt=0.01,
+               maxSteps=10**5, progress=None, onDone=None):
+        """
+        This relaxes the fields for every detuning in Delta at once, holding
+        e1/e2 as complex arrays and stepping them with the given integrator.
+        Each detuning has its own convergence test, |d|e1|| <= Noise*h/dt on
+        an accepted step of size h (for Euler at h = dt this is the original
+        |d|e1|| <= Noise test), and is dropped from the working set as soon as
+        it has settled, so one step only costs a handful of array operations
+        over the unconverged points. Points still moving after maxSteps
+        attempted steps (e.g. self-pulsing states) are stopped there.
+        Returns the relaxed fields with the number of accepted steps,
+        derivative evaluations and the wall time until it settled for each
+        point. The progress reporter, if given, is updated on every step with
+        the number of points that have settled, and onDone, if given, is
+        called with the positions in Delta of the points that have just
+        settled and their fields, steps, evaluations and wall times.
+        """
+        N = len(Delta)
+        e1Out = np.zeros(N, dtype=complex)
+        e2Out = np.zeros(N, dtype=complex)
+        steps = np.zeros(N, dtype=int)
+        nfev = np.zeros(N, dtype=int)
+        # Working set of the detunings that have not converged yet
+        index = np.arange(N)
+        Delta = np.array(Delta, dtype=float)
+        y = np.array([np.broadcast_to(e1, N), np.broadcast_to(e2, N)],
+                     dtype=complex)
+        t = np.zeros(N)
+        h = np.full(N, integrator.dt)
+        k1 = None
+        pwrNew = np.full(N, 10.0)
+        count = np.zeros(N, dtype=int)
+        attempts = np.zeros(N, dtype=int)
+        wallTime = np.zeros(N)
+        start = time.perf_counter()
+        
+        def f(t, y):
+            return np.array(_fieldDerivatives(y[0], y[1], self.e1_tilda,
+                                              self.e2_tilda, Delta, Delta))
+        
+        while index.size:
+            y, hNext, accepted, k1 = integrator.step(f, t, y, h, k1)
+            y += accepted*Noise*self.rng.normal(size=y.shape)
+            t = t + accepted*h
+            pwrOld = pwrNew
+            pwrNew = abs(y[0])
+            count += accepted
+            attempts += 1
+            done = ((accepted & (abs(pwrNew-pwrOld) <= Noise*h/dt)) |
+                    (attempts >= maxSteps))
+            h = hNext
+            if done.any():
+                e1Out[index[done]] = y[0, done]
+                e2Out[index[done]] = y[1, done]
+                steps[index[done]] = count[done]
+                wallTime[index[done]] = time.perf_counter() - start
+                nfev[index[done]] = (integrator.stages*attempts[done] +
+                                     (k1 is not None))
+                if onDone is not None:
+                    finished = index[done]
+                    onDone(finished, e1Out[finished], e2Out[finished],
+                           steps[finished], nfev[finished],
+                           wallTime[finished])
+                keep = ~done
+                index, Delta, t, h = index[keep], Delta[keep], t[keep], h[keep]
+                y, pwrNew = y[:, keep], pwrNew[keep]
+                count, attempts = count[keep], attempts[keep]
+                if k1 is not None:
+                    k1 = k1[:, keep]
+            if progress is not None:
+                progress.update(progress.total - index.size)
+        return e1Out, e2Out, steps, nfev, wallTime
+    
+    def _residual(self, e1, e2, Delta):
+        """
+        This returns the larger of |e1_dot| and |e2_dot| at the fields e1 and
+        e2, i.e. how far they are from a steady state.
+        """
+        e1_dot, e2_dot = _fieldDerivatives(e1, e2, self.e1_tilda,
+                                           self.e2_tilda, Delta, Delta)
+        return np.maximum(abs(e1_dot), abs(e2_dot))
+        
+    def _scanBatch(self, detunings, integrator, Noise, dt, store=None,
+                   progress=None, maxSteps=10**5):
+        """
+        This relaxes the fields for all detunings together (see _relax).
+        NB - every detuning starts from e1 = e2 = 1+1j rather than from the
+        previous detuning's state, so inside a bistable region the branch
+        reached can differ from that of the sequential (adiabatic) scan.
+        If there is a store, only the detunings it does not hold yet are
+        relaxed, and each one is put in the store as soon as it has settled
+        (in whatever order that happens), so an interrupted batch scan keeps
+        the detunings that had settled.
+        Returns |e1|, |e2| and the dictionary of per-point records (see
+        frequencyScan).
+        """
+        todo = (np.arange(len(detunings)) if store is None else
+                store.remaining())
+        
+        def save(index, e1, e2, steps, nfev, wallTime):
+            Delta = detunings[todo[index]]
+            store.put(todo[index], np.stack(
+                [Delta, abs(e1), abs(e2), e1.real, e1.imag, e2.real,
+                 e2.imag, steps, nfev, wallTime,
+                 self._residual(e1, e2, Delta)], axis=-1))
+        
+        e1, e2, steps, nfev, wallTime = self._relax(
+            1.0 + 1.0j, 1.0 + 1.0j, detunings[todo], integrator, Noise, dt,
+            maxSteps, progress, onDone=None if store is None else save)
+        records = {'steps':steps, 'nfev':nfev, 'wallTime':wallTime,
+                   'residual':self._residual(e1, e2, detunings[todo])}
+        if store is not None:
+            store.flush()
+            rows = store.data[:len(detunings)]
+            e1 = rows[:, 3] + 1.0j*rows[:, 4]
+            e2 = rows[:, 5] + 1.0j*rows[:, 6]
+            records = _storedRecords(store)
+        self.e1, self.e2 = e1[-1], e2[-1]
+        self.Delta1 = self.Delta2 = detunings[-1]
+        return abs(e1), abs(e2), records
+        
+    def _scanSequential(self, detunings, p1, p2, integrator, Noise, dt,
+                        oscillation, amp, freq, decimate=1, store=None,
+                        progress=None, maxSteps=10**5):
+        """
+        This relaxes the fields one detuning at a time, starting each
+        detuning from the state reached at the previous one. The Euler
+        integrator runs the original scalar loop, any other integrator
+        relaxes each detuning through _relax, and either way a detuning
+        that has not settled after maxSteps steps (e.g. a self-pulsing
+        state) is stopped there. Each finished detuning is appended to
+        the store, if there is one, and detunings it already holds are not
+        run again: the scan carries on from its last stored fields.
+        Returns |e1|, |e2|, the dictionary of per-point records (see
+        frequencyScan) and the list of oscillation trajectories.
+        """
+        N = len(detunings)
+        pwr1 = np.zeros(N)
+        pwr2 = np.zeros(N)
+        records = {'steps':np.zeros(N, dtype=int),
+                   'nfev':np.zeros(N, dtype=int),
+                   'wallTime':np.zeros(N),
+                   'residual':np.zeros(N)}
+        steps = records['steps']
+        nfev = records['nfev']
+        trajectories = []
+        start = 0
+        if store is not None and store.completed:
+            start = store.completed
+            pwr1[:start] = store.column('pwr1')
+            pwr2[:start] = store.column('pwr2')
+            for key, value in _storedRecords(store).items():
+                records[key][:start] = value
+            last = store.data[start-1]
+            self.e1 = last[3] + 1.0j*last[4]
+            self.e2 = last[5] + 1.0j*last[6]
+        if progress is not None:
+            progress.update(start)
+        for index, det in enumerate(detunings):            
+            if index < start:
+                continue
+            tStart = time.perf_counter()
+            self.Delta1 = det
+            self.Delta2 = det
+            if not isinstance(integrator, eulerIntegrator):
+                e1, e2, count, evals, _ = self._relax(self.e1, self.e2,
+                                                      [det], integrator,
+                                                      Noise, dt, maxSteps)
+                self.e1, self.e2 = e1[0], e2[0]
+                steps[index], nfev[index] = count[0], evals[0]
+            else:
+                h = integrator.dt
+                pwrOld = 0
+                pwrNew = 10
+                count = 0
+                while abs(pwrNew-pwrOld)>Noise and count < maxSteps:
+                    self._getFieldDerivatives()
+                    self.e1 += h*self.e1_dot + Noise*self.rng.normal()
+                    self.e2 += h*self.e2_dot + Noise*self.rng.normal()
+                    pwrOld=pwrNew
+                    pwrNew = abs(self.e1)
+                    count+=1
+                steps[index] = nfev[index] = count
+            pwr1[index] = abs(self.e1)
+            pwr2[index] = abs(self.e2)
+            p0 = abs(self.e1)
+            records['residual'][index] = self._residual(self.e1, self.e2, det)
+            
+            if oscillation:
+                trajectories.append(self._oscillate(det, p1, p2, amp, freq,
+                                                    integrator, Noise,
+                                                    decimate))
+            records['wallTime'][index] = time.perf_counter() - tStart
+            if store is not None:
+                store.append([det, pwr1[index], pwr2[index], self.e1.real,
+                              self.e1.imag, self.e2.real, self.e2.imag] +
+                             [records[key][index] for key in scanRecords])
+            if progress is not None:
+                progress.update(index + 1)
+                
+        return pwr1, pwr2, records, trajectories
+        
+    def _oscillate(self, det, p1, p2, amp, freq, integrator, Noise,
+                   decimate=1, maxPhase=12*np.pi):
+        """
+        This integrates the fields at the detuning det through maxPhase of the
+        sinusoidal input modulation (one modulation cycle takes freq units of
+        time), starting from the current fields. Every decimate-th accepted
+        step is written into preallocated arrays, which are returned in a
+        dictionary of the modulation phase, e1, e2 and e1_tilda.
+        """
+        def f(t, y):
+            phase = 2*np.pi*t/freq
+            e1_tilda = np.sqrt(p1*(1 + amp*np.cos(phase)))
+            e2_tilda = np.sqrt(p2)*(1 - 0.0*amp*np.sin(phase))
+            return np.array(_fieldDerivatives(y[0], y[1], e1_tilda,
+                                              e2_tilda, det, det))
+        
+        # Size the record for the fixed step, adaptive runs grow it if needed
+        size = int(maxPhase*freq/(2*np.pi*integrator.dt))//decimate + 2
+        record = {'phase':np.zeros(size),
+                  'e1':np.zeros(size, dtype=complex),
+                  'e2':np.zeros(size, dtype=complex),
+                  'e1_tilda':np.zeros(size)}
+        y = np.array([self.e1, self.e2])
+        h = integrator.dt
+        k1 = None
+        phase = 0
+        count = 0
+        n = 0
+        while phase < maxPhase:
+            t = phase*freq/(2*np.pi)
+            y, hNext, accepted, k1 = integrator.step(f, t, y, h, k1)
+            if accepted:
+                y += Noise*self.rng.normal(size=2)
+                phase += h*2*np.pi/freq
+                count += 1
+                if count % decimate == 0:
+                    if n == size:
+                        size *= 2
+                        for key, value in record.items():
+                            record[key] = np.resize(value, size)
+                    record['phase'][n] = phase
+                    record['e1'][n], record['e2'][n] = y
+                    n += 1
+            h = hNext
+        self.e1, self.e2 = y
+        self.e1_tilda = np.sqrt(p1*(1 + amp*np.cos(phase)))
+        self.e2_tilda = np.sqrt(p2)*(1 - 0.0*amp*np.sin(phase))
+        for key, value in record.items():
+            record[key] = value[:n]
+        record['e1_tilda'] = np.sqrt(p1*(1 + amp*np.cos(record['phase'])))
+        return record
+        
+    def _scanCached(self, detunings, p1, p2, integrator, Noise, dt, batch,
+                    cache, progress=None, maxSteps=10**5):
+        """
+        This runs a scan through the cache (see frequencyScan). Batch scans
+        are cached per detuning and only the missing detunings are relaxed,
+        sequential scans are cached as a whole. The per-point records of
+        cached points are those of the run that computed them.
+        """
+        key = cache.key(material=self.material,
+                        resonator_params=self.resonator_params, p1=p1, p2=p2,
+                        Noise=Noise, batch=batch, maxSteps=maxSteps,
+                        integrator=dict(vars(integrator),
+                                        name=type(integrator).__name__))
+        if batch:
+            def compute(missing):
+                e1, e2, steps, nfev, wallTime = self._relax(
+                    1.0 + 1.0j, 1.0 + 1.0j, missing, integrator, Noise, dt,
+                    maxSteps, progress)
+                return {'e1':e1, 'e2':e2, 'steps':steps, 'nfev':nfev,
+                        'wallTime':wallTime,
+                        'residual':self._residual(e1, e2, missing)}
+            result = cache.pointwise(key, detunings, compute)
+            e1, e2 = result['e1'][-1], result['e2'][-1]
+            result['pwr1'], result['pwr2'] = abs(result['e1']), abs(result['e2'])
+        else:
+            key = cache.key(key=key, detunings=detunings)
+            result = cache.load(key)
+            if result is None:
+                pwr1, pwr2, records, _ = self._scanSequential(
+                    detunings, p1, p2, integrator, Noise, dt, False, None,
+                    None, progress=progress, maxSteps=maxSteps)
+                result = dict(records, pwr1=pwr1, pwr2=pwr2,
+                              e=np.array([self.e1, self.e2]))
+                cache.save(key, **result)
+            e1, e2 = result['e']
+        self.e1, self.e2 = e1, e2
+        self.Delta1 = self.Delta2 = detunings[-1]
+        records = {key:result[key] for key in scanRecords}
+        return result['pwr1'], result['pwr2'], records
+    
     def frequencyScan(self,Del0=-4,Del1=7,p1=1.4,p2=1.4,N=10,oscillation=False,
-                      amp=None, freq=None, Noise=1e-9):
+                      amp=None, freq=None, Noise=1e-9, batch=False,
+                      integrator='euler', dt=0.01, rtol=1e-7, atol=1e-9,
+                      plot=True, rng=None, decimate=1, store=None,
+                      cache=None, progress=True, profile=False,
+                      maxSteps=10**5):
+        """
+        This scans the detuning from Del0 to Del1 in N steps, relaxing the
+        fields at each detuning, and returns the detunings with the resulting
+        field amplitudes |e1| and |e2|.
+        If batch is True, all detunings are relaxed together as NumPy arrays
+        (see _scanBatch), which is much faster for large N but cannot be
+        combined with oscillation.
+        The time stepping uses the given integrator ('euler', the fixed step
+        reference, or 'dopri5', the adaptive Dormand-Prince method controlled
+        by rtol/atol, see integrators.py); dt is the Euler step and the
+        initial adaptive step. The number of accepted steps ('steps'),
+        derivative evaluations ('nfev'), the wall time ('wallTime', for batch
+        scans the time until the point settled) and the final residual
+        max(|e1_dot|, |e2_dot|) ('residual') for each detuning are kept in
+        self.scanInfo. A detuning that has not settled after maxSteps steps
+        (e.g. a self-pulsing state) is stopped there.
+        progress is a callback progress(done, total), True for the terminal
+        progress bar or False for none, and is called at most every 0.1 s
+        (see progressReporter). With profile=True (or a scanProfiler), the
+        time spent integrating, drawing random numbers, in the stability
+        analysis and plotting is kept in self.scanInfo['profile'].
+        With plot=False no figures are made, so the scan can run headless,
+        and rng sets the random generator used for the noise (e.g. a seeded
+        numpy.random.Generator, the default is the global numpy.random).
+        With oscillation, the fields through the modulation at each detuning
+        are recorded (every decimate-th step) and kept as a list of
+        dictionaries in self.scanInfo['trajectories'] (see _oscillate), and
+        are only plotted at the end, one figure per detuning, if plot is True.
+        If store is a directory (or a resultStore), every finished detuning
+        is saved there as the scan goes (in batch mode, as each detuning
+        settles), along with the resonator parameters
+        and scan settings, and a scan that was interrupted carries on from
+        its last saved detuning when it is run again with the same store
+        (see resultStore.py; oscillation trajectories are not stored).
+        Without oscillation, the eigenvalues of the Jacobian at the state
+        reached at each detuning, whether it is stable and the bifurcations
+        between neighbouring detunings are also kept in self.scanInfo (see
+        stability.py).
+        With cache (True for the default directory, a directory name or a
+        simCache), results are looked up by a hash of the parameters and
+        scan settings before anything is integrated (see simCache.py). Batch
+        scans are cached per detuning, so only the detunings missing from the
+        cache are relaxed; sequential scans depend on the path through the
+        detunings and are only reused when the whole scan is repeated. Note
+        the noise is not part of the key, so a cached scan is one realization.
+        """
+        assert not (batch and oscillation), ('The batch scan does not support'
+                                             ' the oscillation branch')
+        assert not (cache and (oscillation or store is not None)), (
+            'The cache does not support oscillation or stored scans')
         if oscillation:
             # Make sure there is an amplitude and frequency given if the
             # simulation is oscillating
@@ -82,97 +439,499 @@ class wgm_resonator:
         self.e2 = 1.0 + 1.0j
         
         detunings = np.linspace(Del0, Del1, N)        
-        pwr1 = np.zeros(N)
-        pwr2 = np.zeros(N)
         M1 = np.zeros(N)
         M2 = np.zeros(N)
-        dt = 0.01
-        scanFig = plt.figure()
-        scanAx = scanFig.add_subplot(111)
+        integrator = getIntegrator(integrator, dt=dt, rtol=rtol, atol=atol)
+        rng = np.random if rng is None else rng
+        profiler = scanProfiler() if profile is True else profile or None
+        if profiler is None:
+            timer = lambda name: nullcontext()
+            self.rng = rng
+        else:
+            timer = profiler.section
+            self.rng = profiler.timedRng(rng)
+        progress = progressReporter(progress, N)
+        if isinstance(store, str):
+            metadata = {'material':self.material,
+                        'resonator_params':self.resonator_params,
+                        'scan':{'Del0':Del0, 'Del1':Del1, 'p1':p1, 'p2':p2,
+                                'N':N, 'Noise':Noise, 'batch':batch,
+                                'integrator':type(integrator).__name__,
+                                'dt':dt, 'rtol':rtol, 'atol':atol,
+                                'maxSteps':maxSteps}}
+            store = resultStore(store, N, metadata)
         
-        printProgressBar(iteration=0,total=N,prefix = 'Scanning frequency',
-                         length=50)
-        for index, det in enumerate(detunings):            
-            printProgressBar(iteration=index,total=N,
-                             prefix = 'Scanning frequency',length=50)
-            self.Delta1 = det
-            self.Delta2 = det
-            pwrOld = 0
-            pwrNew = 10
-            count = 0
-            while abs(pwrNew-pwrOld)>Noise:
-                self._getFieldDerivatives()
-                self.e1 += dt*self.e1_dot + Noise*np.random.normal()
-                self.e2 += dt*self.e2_dot + Noise*np.random.normal()
-                pwrOld += dt*(pwrNew-pwrOld)
-                pwrOld=pwrNew
-                pwrNew = abs(self.e1)
-                count+=1                
-            pwr1[index] = abs(self.e1)
-            pwr2[index] = abs(self.e2)
-            p0 = abs(self.e1)
-            
-            if oscillation:
-                oscFig = plt.figure()
-                oscAx = oscFig.add_subplot(111)
-                
-                phase = 0
-                dphase = dt*2*np.pi/freq
-                maxPhase = 12*np.pi
-                
-                while phase < maxPhase:
-                    self.e1_tilda = np.sqrt(p1*(1 + amp*np.cos(phase)))
-                    self.e2_tilda = np.sqrt(p2)*(1 - 0.0*amp*np.sin(phase))
-                    self._getFieldDerivatives()
-                    self.e1 += dt*self.e1_dot + Noise*np.random.normal()
-                    self.e2 += dt*self.e2_dot + Noise*np.random.normal()
-                    
-                    phase += dphase
-                    
-                    oscAx.plot(phase%(2*np.pi),abs(self.e1_tilda),'k.',alpha=0.1)
-                    oscAx.plot(phase%(2*np.pi),abs(self.e1),'r.',alpha=0.1)
-                    oscAx.plot(phase%(2*np.pi),abs(self.e2),'b.',alpha=0.1)
-                    
-                    if abs(phase-maxPhase)<2*np.pi:
-                        oscAx.plot(phase%(2*np.pi),abs(self.e1),'k.',alpha=0.1)
-                        oscAx.plot(phase%(2*np.pi),abs(self.e2),'k.',alpha=0.1)
-                        
-                        
-                        
-                oscAx.plot(np.nan,np.nan,'k.',label='input')
-                oscAx.plot(np.nan,np.nan,'r.',label='Modulated cavity field')
-                oscAx.plot(np.nan,np.nan,'b.',label='Counter-modulated cavity field')
-                oscAx.set_xlabel('Phase of input oscillation')
-                oscAx.set_ylabel('Power')
-                oscAx.legend()
+        cache = getCache(cache)
+        
+        try:
+            with timer('integration'):
+                if cache is not None:
+                    pwr1, pwr2, records = self._scanCached(detunings, p1, p2,
+                                                           integrator, Noise,
+                                                           dt, batch, cache,
+                                                           progress, maxSteps)
+                    trajectories = []
+                elif batch:
+                    pwr1, pwr2, records = self._scanBatch(detunings,
+                                                          integrator, Noise,
+                                                          dt, store, progress,
+                                                          maxSteps)
+                    trajectories = []
+                else:
+                    (pwr1, pwr2, records,
+                     trajectories) = self._scanSequential(detunings, p1, p2,
+                                                          integrator, Noise,
+                                                          dt, oscillation,
+                                                          amp, freq, decimate,
+                                                          store, progress,
+                                                          maxSteps)
+        finally:
+            # Keep whatever has been finished if the scan is interrupted
+            if store is not None:
+                store.flush()
+            self.rng = rng
+        self.scanInfo = dict(records, trajectories=trajectories)
+        if not oscillation:
+            # Linear stability of the state reached at each detuning, from
+            # the analytic Jacobian (see stability.py)
+            from .stability import (fieldsFromIntensities, stateStability,
+                                    classifyBifurcations)
+            with timer('stability'):
+                e1, e2 = fieldsFromIntensities(pwr1**2, pwr2**2, p1, p2,
+                                               detunings)
+                eigenvalues, stable = stateStability(e1, e2, detunings)
+                bifurcations = classifyBifurcations(e1, e2, detunings,
+                                                    eigenvalues)
+            self.scanInfo.update({'eigenvalues':eigenvalues, 'stable':stable,
+                                  'bifurcations':bifurcations})
                 
-        plt.plot(detunings,pwr1,'r',alpha=0.5)
-        plt.plot(detunings,pwr2,'b',alpha=0.5)
-#        plt.plot(detunings,M1+M2,'k')
+        if plot:
+            with timer('plotting'):
+                scanFig = plt.figure()
+                scanAx = scanFig.add_subplot(111)
+                scanAx.plot(detunings,pwr1,'r',alpha=0.5)
+                scanAx.plot(detunings,pwr2,'b',alpha=0.5)
+#                scanAx.plot(detunings,M1+M2,'k')
+                for trajectory in trajectories:
+                    plotTrajectory(trajectory)
+        if profiler is not None:
+            self.scanInfo['profile'] = profiler.report()
+        return detunings, pwr1, pwr2
+    
+    def steadyStates(self, Del0=-4, Del1=7, p1=1.4, p2=1.4, N=10, nStart=8,
+                     tol=1e-10, maxIter=100, cache=None):
+        """
+        This finds the steady states of the field equations directly, solving
+        e1_dot = e2_dot = 0 with a Newton solver that is vectorized over all
+        N detunings and an nStart x nStart grid of initial guesses at once.
+        Every coexisting solution is returned, whether it is symmetric,
+        symmetry broken or unstable, as the (N, K) complex arrays e1 and e2,
+        where K is the largest number of solutions found at any detuning and
+        unused entries are NaN.
+        With cache (see frequencyScan and simCache.py), the solutions are
+        cached per detuning and only the detunings missing from the cache are
+        solved for.
+        """
+        detunings = np.linspace(Del0, Del1, N)
+        cache = getCache(cache)
+        if cache is None:
+            I1, I2 = _solveSteadyStates(detunings, p1, p2, nStart, tol,
+                                        maxIter)
+        else:
+            def compute(missing):
+                I1, I2 = _solveSteadyStates(missing, p1, p2, nStart, tol,
+                                            maxIter)
+                return {'I1':I1, 'I2':I2}
+            key = cache.key(kind='steadyStates', p1=p1, p2=p2, nStart=nStart,
+                            tol=tol, maxIter=maxIter)
+            result = cache.pointwise(key, detunings, compute)
+            I1, I2 = result['I1'], result['I2']
+            K = max(1, (~np.isnan(I1)).sum(axis=1).max())
+            I1, I2 = I1[:, :K], I2[:, :K]
+        Delta = detunings[:, np.newaxis]
+        with np.errstate(invalid='ignore'):
+            e1 = np.sqrt(p1)/(1 + 1.0j*(I1 + 2*I2 - Delta))
+            e2 = np.sqrt(p2)/(1 + 1.0j*(I2 + 2*I1 - Delta))
+        return detunings, e1, e2
+    
+    def switchingStatistics(self, Delta=3, p1=4, p2=4, M=1000, T=500,
+                            dt=0.01, sigma=1e-2, seed=None, e0=0.0,
+                            threshold=None, block=1000):
+        """
+        This runs an ensemble of M noisy trajectories at the detuning Delta
+        together, as arrays of length M, integrating the stochastic field
+        equations de = e_dot*dt + sigma*dW with the Euler-Maruyama method for
+        a time T, starting from the fields e0. dW is complex Gaussian noise of
+        variance dt, drawn from a numpy.random.Generator seeded with seed, in
+        blocks of block steps.
+        The state of each trajectory is followed through its intensity
+        asymmetry I1 - I2: it counts as broken towards e1 (+1) or e2 (-1)
+        once the asymmetry passes +threshold or -threshold, and stays there
+        until it passes the opposite one. By default threshold is half the
+        asymmetry of the symmetry-broken steady states at Delta.
+        Returns a dictionary of the direction each trajectory first broke
+        towards (0 if it never did) and when, its final direction, the number
+        of switches, the dwell times between switches of all trajectories,
+        and the final fields.
+        """
+        rng = np.random.default_rng(seed)
+        if threshold is None:
+            I1, I2 = _solveSteadyStates([Delta], p1, p2)
+            asymmetry = np.nanmax(abs(I1 - I2))
+            threshold = (0.5*asymmetry if asymmetry > 0 else
+                         0.05*max(p1, p2))
+        e1_tilda, e2_tilda = np.sqrt(p1), np.sqrt(p2)
+        e1 = np.full(M, e0, dtype=complex)
+        e2 = np.full(M, e0, dtype=complex)
+        state = np.zeros(M, dtype=int)
+        firstDirection = np.zeros(M, dtype=int)
+        breakTime = np.full(M, np.nan)
+        lastSwitch = np.zeros(M)
+        switches = np.zeros(M, dtype=int)
+        dwellTimes = []
+        nSteps = int(round(T/dt))
+        scale = sigma*np.sqrt(dt/2)
+        for start in range(0, nSteps, block):
+            n = min(block, nSteps - start)
+            noise = rng.standard_normal((n, 4, M))
+            dW1 = scale*(noise[:, 0] + 1.0j*noise[:, 1])
+            dW2 = scale*(noise[:, 2] + 1.0j*noise[:, 3])
+            for i in range(n):
+                e1_dot, e2_dot = _fieldDerivatives(e1, e2, e1_tilda,
+                                                   e2_tilda, Delta, Delta)
+                e1 += dt*e1_dot + dW1[i]
+                e2 += dt*e2_dot + dW2[i]
+                asymmetry = (e1.real**2 + e1.imag**2 -
+                             e2.real**2 - e2.imag**2)
+                new = np.where(asymmetry > threshold, 1,
+                               np.where(asymmetry < -threshold, -1, state))
+                changed = new != state
+                if changed.any():
+                    t = (start + i + 1)*dt
+                    first = changed & (state == 0)
+                    firstDirection[first] = new[first]
+                    breakTime[first] = t
+                    switched = changed & (state != 0)
+                    dwellTimes.append(t - lastSwitch[switched])
+                    switches += switched
+                    lastSwitch[changed] = t
+                    state = new
+        return {'firstDirection':firstDirection,
+                'breakTime':breakTime,
+                'direction':state,
+                'switches':switches,
+                'dwellTimes':np.concatenate(dwellTimes + [np.zeros(0)]),
+                'e1':e1,
+                'e2':e2}
+    
+    def periodicResponse(self, Delta=1, freq=5, amp=0.05, p1=1.4, p2=1.4,
+                         state=0, K=200, hMax=0.5, tol=1e-10, maxIter=20):
+        """
+        This finds the periodic steady state of the fields under the
+        sinusoidal input modulation e1_tilda = sqrt(p1*(1 + amp*cos(phase)))
+        directly, by Newton shooting on the map over one modulation period,
+        instead of integrating through the transients. As in frequencyScan,
+        one modulation cycle takes freq units of time.
+        Delta, freq and amp may be arrays, which are broadcast together and
+        solved as one batch, so a full response map over (Delta, freq, amp)
+        is a single call. Each point starts from one of the unmodulated
+        steady states, chosen by state in order of increasing I1 (0 is the
+        lowest, -1 the highest). Each period is integrated in fourth order
+        Runge-Kutta steps, a multiple of K per period chosen for each point
+        so the step is at most hMax (slow modulations need more steps to stay
+        stable), together with the variational equations, which give the
+        monodromy matrix used for the Newton step.
+        Returns a dictionary of the gain and phase (relative to the input
+        power modulation) of the first harmonic of |e1|^2 and |e2|^2, the
+        orbits e1, e2 sampled at K points per period, the Floquet
+        multipliers of each orbit and whether it converged. Points whose
+        integration blows up are not converged and have NaN results, without
+        affecting the rest of the batch.
+        """
+        Delta, freq, amp = np.broadcast_arrays(*[np.asarray(x, dtype=float)
+                                                 for x in (Delta, freq, amp)])
+        shape = Delta.shape
+        Delta, freq, amp = Delta.ravel(), freq.ravel(), amp.ravel()
+        B = Delta.size
+        # Steps per orbit sample, so the step freq/(K*m) is at most hMax
+        m = np.maximum(1, np.ceil(freq/(K*hMax))).astype(int)
+        steps = K*m
+        h = freq/steps
+        
+        def f(t, y):
+            phase = 2*np.pi*t/freq
+            e1_tilda = np.sqrt(p1*(1 + amp*np.cos(phase)))
+            return np.array(_fieldDerivatives(y[0], y[1], e1_tilda,
+                                              np.sqrt(p2), Delta, Delta))
+        
+        def period(y, variational=True):
+            # Integrate one period from y, returning the end state with the
+            # monodromy matrix, or the orbit samples if not variational.
+            # Points with fewer steps stand still (step 0) once done
+            Phi = np.tile(np.eye(4), (B, 1, 1))
+            orbit = np.zeros((K, 2, B), dtype=complex)
+            for k in range(steps.max()):
+                t = k*h
+                hk = np.where(k < steps, h, 0)
+                if not variational:
+                    sample = (k % m == 0) & (k < steps)
+                    orbit[k//m[sample], :, sample] = y[:, sample].T
+                    k1 = f(t, y)
+                    k2 = f(t + hk/2, y + hk/2*k1)
+                    k3 = f(t + hk/2, y + hk/2*k2)
+                    k4 = f(t + hk, y + hk*k3)
+                    y = y + hk/6*(k1 + 2*k2 + 2*k3 + k4)
+                    continue
+                ks = []
+                ys, Phis = y, Phi
+                for c in [0, 0.5, 0.5, 1]:
+                    if ks:
+                        ys = y + c*hk*ks[-1][0]
+                        Phis = Phi + (c*hk)[:, np.newaxis, np.newaxis]*ks[-1][1]
+                    J = _fieldJacobian(ys[0], ys[1], Delta, Delta)
+                    ks.append((f(t + c*hk, ys), J @ Phis))
+                y = y + hk/6*(ks[0][0] + 2*ks[1][0] + 2*ks[2][0] + ks[3][0])
+                Phi = Phi + (hk/6)[:, np.newaxis, np.newaxis]*(
+                    ks[0][1] + 2*ks[1][1] + 2*ks[2][1] + ks[3][1])
+            return (y, Phi) if variational else orbit
+        
+        # Start from the chosen unmodulated steady state at each detuning
+        I1, I2 = _solveSteadyStates(Delta, p1, p2)
+        n = (~np.isnan(I1)).sum(axis=1)
+        index = np.clip(np.where(state < 0, n + state, state), 0, n - 1)
+        I1 = I1[np.arange(B), index]
+        I2 = I2[np.arange(B), index]
+        y = np.array([np.sqrt(p1)/(1 + 1.0j*(I1 + 2*I2 - Delta)),
+                      np.sqrt(p2)/(1 + 1.0j*(I2 + 2*I1 - Delta))])
+        converged = np.zeros(B, dtype=bool)
+        finite = np.ones(B, dtype=bool)
+        with np.errstate(over='ignore', invalid='ignore'):
+            for _ in range(maxIter):
+                yT, M = period(y)
+                G = _toReal(yT - y)
+                # A point that blew up is left out of the rest of the solve
+                finite &= (np.isfinite(G).all(axis=1) &
+                           np.isfinite(M).all(axis=(1, 2)))
+                converged = finite & (np.max(abs(G), axis=1) < tol)
+                active = finite & ~converged
+                if not active.any():
+                    break
+                dx = np.linalg.solve(M[active] - np.eye(4),
+                                     -G[active, :, np.newaxis])[..., 0]
+                y[:, active] += _toComplex(dx)
+            multipliers = np.full((B, 4), np.nan, dtype=complex)
+            multipliers[finite] = np.linalg.eigvals(M[finite])
+            orbit = period(y, variational=False)
+        orbit[:, :, ~finite] = np.nan
+        # First harmonic of the intracavity powers relative to the input
+        # power modulation p*amp*cos(phase)
+        harmonic = np.exp(-2j*np.pi*np.arange(K)/K)[:, np.newaxis]
+        c1 = 2*np.mean(abs(orbit[:, 0])**2*harmonic, axis=0)
+        c2 = 2*np.mean(abs(orbit[:, 1])**2*harmonic, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain1 = abs(c1)/(p1*amp)
+            gain2 = abs(c2)/(p1*amp)
+        return {'gain1':gain1.reshape(shape),
+                'phase1':np.angle(c1).reshape(shape),
+                'gain2':gain2.reshape(shape),
+                'phase2':np.angle(c2).reshape(shape),
+                'e1':orbit[:, 0].T.reshape(shape + (K,)),
+                'e2':orbit[:, 1].T.reshape(shape + (K,)),
+                'multipliers':multipliers.reshape(shape + (4,)),
+                'converged':converged.reshape(shape)}
+    
+    def branchScan(self, Del0=-4, Del1=7, p1=1.4, p2=1.4, ds=0.05, dsMax=0.3):
+        """
+        This traces every steady state branch between Del0 and Del1 through
+        its folds and symmetry-breaking bifurcations by pseudo-arclength
+        continuation (see continuation.py), instead of scanning a dense
+        detuning grid in both directions. Returns the list of branches, each
+        an (n, 3) array of (I1, I2, Delta), with the (k, 3) arrays of fold
+        and branch points. The number of corrector solves is kept in
+        self.scanInfo, with the stability of every point of each branch and
+        the bifurcations along it (see branchStability in stability.py).
+        """
+        from .continuation import continueBranches
+        from .stability import branchStability
+        branches, folds, branchPoints, solves = continueBranches(Del0, Del1,
+                                                                 p1, p2, ds,
+                                                                 dsMax=dsMax)
+        analysis = [branchStability(branch, p1, p2) for branch in branches]
+        self.scanInfo = {'solves':solves,
+                         'stable':[stable for _, stable, _ in analysis],
+                         'bifurcations':[b for _, _, b in analysis]}
+        return branches, folds, branchPoints
             
-def _load_struct(name, data_type):
+def plotTrajectory(trajectory, ax=None):
+    """
+    This function plots a trajectory recorded by the oscillation branch of
+    frequencyScan against the phase of the input modulation, with a single
+    plot call per curve. The last modulation cycle is overlaid in black.
+    """
+    if ax is None:
+        ax = plt.figure().add_subplot(111)
+    phase = trajectory['phase']
+    wrapped = phase%(2*np.pi)
+    e1 = abs(trajectory['e1'])
+    e2 = abs(trajectory['e2'])
+    ax.plot(wrapped,abs(trajectory['e1_tilda']),'k.',alpha=0.1,label='input')
+    ax.plot(wrapped,e1,'r.',alpha=0.1,label='Modulated cavity field')
+    ax.plot(wrapped,e2,'b.',alpha=0.1,label='Counter-modulated cavity field')
+    if len(phase):
+        last = phase > phase[-1] - 2*np.pi
+        ax.plot(np.tile(wrapped[last],2),np.append(e1[last],e2[last]),'k.',
+                alpha=0.1)
+    ax.set_xlabel('Phase of input oscillation')
+    ax.set_ylabel('Power')
+    ax.legend()
+    return ax
+
+def _storedRecords(store):
+    """
+    This function reads the per-point records of the completed rows of a
+    scan's resultStore.
+    """
+    records = {key:store.column(key) for key in scanRecords}
+    for key in ['steps', 'nfev']:
+        records[key] = records[key].astype(int)
+    return records
+
+def _fieldDerivatives(e1, e2, e1_tilda, e2_tilda, Delta1, Delta2):
+    """
+    This function gives the time derivatives of the counter-propagating fields.
+    All arguments may be scalars or broadcastable NumPy arrays, so the same
+    equations serve both the scalar and the batch simulations.
+    """
+    I1 = e1.real**2 + e1.imag**2
+    I2 = e2.real**2 + e2.imag**2
+    e1_dot = e1_tilda - (1 + 1.0j*(I1 + 2*I2 - Delta1))*e1
+    e2_dot = e2_tilda - (1 + 1.0j*(I2 + 2*I1 - Delta2))*e2
+    return e1_dot, e2_dot
+
+def _fieldJacobian(e1, e2, Delta1, Delta2):
+    """
+    This function gives the analytic Jacobian of the field equations written
+    as four real equations for (Re e1, Im e1, Re e2, Im e2). The arguments
+    may be broadcastable arrays and the result has shape (..., 4, 4).
+    """
+    e1, e2, Delta1, Delta2 = np.broadcast_arrays(e1, e2, Delta1, Delta2)
+    x1, y1, x2, y2 = e1.real, e1.imag, e2.real, e2.imag
+    phi1 = x1**2 + y1**2 + 2*(x2**2 + y2**2) - Delta1
+    phi2 = x2**2 + y2**2 + 2*(x1**2 + y1**2) - Delta2
+    J = np.empty(e1.shape + (4, 4))
+    J[..., 0, :] = np.stack([-1 + 2*x1*y1, phi1 + 2*y1**2, 4*x2*y1, 4*y2*y1],
+                            axis=-1)
+    J[..., 1, :] = np.stack([-phi1 - 2*x1**2, -1 - 2*x1*y1, -4*x2*x1,
+                             -4*y2*x1], axis=-1)
+    J[..., 2, :] = np.stack([4*x1*y2, 4*y1*y2, -1 + 2*x2*y2, phi2 + 2*y2**2],
+                            axis=-1)
+    J[..., 3, :] = np.stack([-4*x1*x2, -4*y1*x2, -phi2 - 2*x2**2,
+                             -1 - 2*x2*y2], axis=-1)
+    return J
+
+def _toReal(y):
+    """
+    This function turns the complex fields y = (e1, e2), of shape (2, ...),
+    into the real state (Re e1, Im e1, Re e2, Im e2) along the last axis.
+    """
+    return np.stack([y[0].real, y[0].imag, y[1].real, y[1].imag], axis=-1)
+
+def _toComplex(x):
+    """
+    This function is the inverse of _toReal.
+    """
+    return np.array([x[..., 0] + 1.0j*x[..., 1], x[..., 2] + 1.0j*x[..., 3]])
+
+def _steadyStateResidual(I1, I2, p1, p2, Delta):
+    """
+    This function gives the residual of the steady state condition written in
+    terms of the intracavity intensities, p = I*(1 + (I + 2*I_other - Delta)^2)
+    for each direction, along with its Jacobian [[J11, J12], [J21, J22]]
+    with respect to (I1, I2).
+    """
+    x1 = I1 + 2*I2 - Delta
+    x2 = I2 + 2*I1 - Delta
+    F1 = I1*(1 + x1**2) - p1
+    F2 = I2*(1 + x2**2) - p2
+    J11 = 1 + x1**2 + 2*I1*x1
+    J12 = 4*I1*x1
+    J21 = 4*I2*x2
+    J22 = 1 + x2**2 + 2*I2*x2
+    return F1, F2, (J11, J12, J21, J22)
+
+def _solveSteadyStates(detunings, p1, p2, nStart=8, tol=1e-10, maxIter=100):
+    """
+    This function solves for every steady state intensity pair (I1, I2) at
+    each detuning. Newton's method is run from a grid of starting points
+    covering 0 <= I <= p (the only region where solutions can lie) for all
+    detunings at once, and the converged roots are then de-duplicated.
+    Returns two (N, K) arrays padded with NaN.
+    """
+    Delta = np.asarray(detunings, dtype=float)[:, np.newaxis]
+    grid = (np.arange(nStart) + 0.5)/nStart
+    I1 = np.tile(np.repeat(p1*grid, nStart), (len(Delta), 1))
+    I2 = np.tile(np.tile(p2*grid, nStart), (len(Delta), 1))
+    for _ in range(maxIter):
+        F1, F2, (J11, J12, J21, J22) = _steadyStateResidual(I1, I2, p1, p2,
+                                                            Delta)
+        det = J11*J22 - J12*J21
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dI1 = (J22*F1 - J12*F2)/det
+            dI2 = (J11*F2 - J21*F1)/det
+        I1 = np.clip(I1 - np.nan_to_num(dI1), 0, p1)
+        I2 = np.clip(I2 - np.nan_to_num(dI2), 0, p2)
+        if (abs(np.nan_to_num(dI1)) + abs(np.nan_to_num(dI2))).max() < tol:
+            break
+    F1, F2, _ = _steadyStateResidual(I1, I2, p1, p2, Delta)
+    converged = (abs(F1) + abs(F2)) < np.sqrt(tol)*max(1, p1, p2)
+    I1 = np.where(converged, I1, np.nan)
+    I2 = np.where(converged, I2, np.nan)
+    # Sort the roots at each detuning so duplicates sit next to each other
+    # and remove them, leaving the distinct roots at the start of each row
+    match = 1e3*np.sqrt(tol)*max(1, p1, p2)
+    order = np.lexsort((I2, np.round(I1/match)), axis=1)
+    I1 = np.take_along_axis(I1, order, axis=1)
+    I2 = np.take_along_axis(I2, order, axis=1)
+    duplicate = np.zeros(I1.shape, dtype=bool)
+    duplicate[:, 1:] = ((abs(np.diff(I1, axis=1)) < match) &
+                        (abs(np.diff(I2, axis=1)) < match))
+    I1[duplicate] = np.nan
+    I2[duplicate] = np.nan
+    order = np.argsort(np.isnan(I1), axis=1, kind='stable')
+    I1 = np.take_along_axis(I1, order, axis=1)
+    I2 = np.take_along_axis(I2, order, axis=1)
+    K = max(1, (~np.isnan(I1)).sum(axis=1).max())
+    return I1[:, :K], I2[:, :K]
+
+def _load_struct(name, data_type, interactive=None):
     """
     This function loads the data associated with the name and data type, 
-    ensuring easier repeatability/reproducibility of simulations. If this name
-    has yet to be defined, it will ask the user to define it in the command 
-    window.
-    """
-    directory = 'params/wgm_resonator_sim/' + data_type + '/'
-    filename = directory + name + '.txt'
-    # Load file if it exists, if not, as user to create one
-    if os.path.exists(filename):
-        struct =  txt2struct(filename)
-    else:
-        data_keys = {'material':['n0','n2 (cm^2/W)'],
-                     'resonator_params':['Q','lambda (nm)',
-                                         'r (um)','Aeff (um^2)',]}
-        keys = data_keys[data_type]
-        struct = {}
-        for key in keys:
-            struct[key.split()[0]] = input("Enter the {} for {}:".format(key,
-                   name))
-        struct2txt(struct,filename)
-    return struct
+    ensuring easier repeatability/reproducibility of simulations. The data is
+    served from the parameter library (see paramLibrary.py), which reads the
+    files in params/wgm_resonator_sim/ once and keeps them as floats. If this
+    name has yet to be defined, it will ask the user to define it in the
+    command window, unless the library or interactive is set to
+    non-interactive, in which case a KeyError is raised. A structure that has
+    already been loaded can be passed in place of the name, in which case a
+    copy of it is returned without any file I/O. This must be a structure as
+    loaded (e.g. the rawMaterial or rawResonatorParams of a simulation), not
+    the material or resonator_params of a simulation, which have already
+    been converted to SI units.
+    """
+    if isinstance(name, dict):
+        assert not isinstance(name, _convertedStruct), (
+            'The {} structure has already been converted to SI units, pass '
+            'the structure as loaded (rawMaterial or rawResonatorParams) '
+            'instead'.format(data_type))
+        return dict(name)
+    return getLibrary().get(name, data_type, interactive)
+
+class _convertedStruct(dict):
+    """
+    This object is a parameter structure that update_resonator_params has
+    converted to SI units, which _load_struct refuses so it is never
+    converted twice.
+    """
 
 ###############################################################################
         
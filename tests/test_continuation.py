@@ -0,0 +1,27 @@
+"""
+These are the tests of the pseudo-arclength continuation against the
+analytic folds and symmetry-breaking point of the symmetric branch.
+"""
+import numpy as np
+from npm.continuation import continueBranches
+
+
+def test_symmetricFoldAndPitchfork():
+    p = 4
+    branches, folds, branchPoints, _ = continueBranches(-2, 6, p, p)
+    # On the symmetric branch I1 = I2 = I, with x = 3I - Delta, a fold has
+    # 1 + x^2 + 6Ix = 0 and the symmetry breaks where 1 + x^2 - 2Ix = 0
+    symmetric = folds[abs(folds[:, 0] - folds[:, 1]) < 1e-8]
+    assert len(symmetric) == 1
+    I, _, Delta = symmetric[0]
+    x = 3*I - Delta
+    assert abs(I*(1 + x**2) - p) < 1e-8
+    assert abs(1 + x**2 + 6*I*x) < 1e-6
+    assert abs(Delta - 4.1457) < 1e-4
+    assert len(branchPoints) == 1
+    I, I2, Delta = branchPoints[0]
+    x = 3*I - Delta
+    assert abs(I - I2) < 1e-8
+    assert abs(I*(1 + x**2) - p) < 1e-8
+    assert abs(1 + x**2 - 2*I*x) < 1e-6
+    assert abs(Delta - 1.73680) < 1e-5
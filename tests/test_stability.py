@@ -0,0 +1,40 @@
+"""
+These are the tests of the bifurcations classified along scans and
+continuation branches.
+"""
+import numpy as np
+import pytest
+from npm.wgm_resonator import wgm_resonator
+from npm.continuation import continueBranches
+from npm.stability import branchStability
+
+material = {'n0':1.44, 'n2':2.7e-16}
+resonator = {'Q':1e8, 'lambda':1550, 'r':100, 'Aeff':10}
+
+def _inBracket(bifurcations, Delta):
+    index = bifurcations['index']
+    lo = np.minimum(Delta[index], Delta[index + 1])
+    hi = np.maximum(Delta[index], Delta[index + 1])
+    return np.all((lo <= bifurcations['Delta']) & (bifurcations['Delta'] <= hi))
+
+@pytest.mark.parametrize('seed', range(3))
+def test_batchScanBracket(seed):
+    # Neighbouring points of a batch scan can settle on different branches,
+    # which must neither push a bifurcation out of its bracket nor count as
+    # a fold
+    sim = wgm_resonator(material, resonator)
+    Delta, _, _ = sim.frequencyScan(-2, 6, 4, 4, N=40, batch=True,
+                                    plot=False, progress=False,
+                                    rng=np.random.default_rng(seed))
+    bifurcations = sim.scanInfo['bifurcations']
+    assert _inBracket(bifurcations, Delta)
+    assert 'fold' not in bifurcations['type']
+
+def test_branchBracket():
+    branches, _, _, _ = continueBranches(-2, 6, 4, 4)
+    types = []
+    for branch in branches:
+        _, _, bifurcations = branchStability(branch, 4, 4)
+        assert _inBracket(bifurcations, branch[:, 2])
+        types += list(bifurcations['type'])
+    assert 'fold' in types and 'pitchfork' in types
@@ -0,0 +1,103 @@
+"""
+These are the tests of the wgm_resonator steady states, Jacobian, periodic
+response and frequency scans against analytic values and brute force
+integration. The simulations are given their parameters directly, so no
+parameter files are needed.
+"""
+import numpy as np
+import pytest
+from npm.wgm_resonator import (wgm_resonator, _fieldDerivatives,
+                               _fieldJacobian, _solveSteadyStates,
+                               _steadyStateResidual, _toReal, _toComplex)
+
+material = {'n0':1.44, 'n2':2.7e-16}
+resonator = {'Q':1e8, 'lambda':1550, 'r':100, 'Aeff':10}
+
+def _symmetricRoots(p, Delta):
+    """
+    This function returns the real, non-negative roots of the symmetric
+    steady state cubic p = I*(1 + (3I - Delta)^2).
+    """
+    roots = np.roots([9, -6*Delta, 1 + Delta**2, -p])
+    return np.sort(roots[abs(roots.imag) < 1e-9].real)
+
+@pytest.mark.parametrize('p, Delta, count', [(1.4, -4, 1), (1.4, 3.5, 3),
+                                             (1.4, 6, 1), (4, 1, 1),
+                                             (4, 3, 3), (4, 5, 5)])
+def test_steadyStateCount(p, Delta, count):
+    I1, I2 = _solveSteadyStates([Delta], p, p)
+    found = ~np.isnan(I1[0])
+    assert found.sum() == count
+    F1, F2, _ = _steadyStateResidual(I1[0, found], I2[0, found], p, p, Delta)
+    assert np.max(abs(F1) + abs(F2)) < 1e-8
+    symmetric = np.sort(I1[0, found][abs(I1[0, found] - I2[0, found]) < 1e-8])
+    assert np.allclose(symmetric, _symmetricRoots(p, Delta), atol=1e-8)
+
+def test_fieldJacobian():
+    rng = np.random.default_rng(1)
+    e1, e2 = rng.normal(size=(2, 5)) + 1.0j*rng.normal(size=(2, 5))
+    Delta = rng.uniform(-2, 5, 5)
+    J = _fieldJacobian(e1, e2, Delta, Delta)
+    h = 1e-6
+    x = _toReal(np.array([e1, e2]))
+    numeric = np.zeros_like(J)
+    for k in range(4):
+        dx = np.zeros(4)
+        dx[k] = h
+        up = _toReal(np.array(_fieldDerivatives(*_toComplex(x + dx), 1.2,
+                                                0.8, Delta, Delta)))
+        down = _toReal(np.array(_fieldDerivatives(*_toComplex(x - dx), 1.2,
+                                                  0.8, Delta, Delta)))
+        numeric[..., k] = (up - down)/(2*h)
+    assert np.allclose(J, numeric, atol=1e-6)
+
+def test_periodicResponse():
+    sim = wgm_resonator(material, resonator)
+    Delta, freq, amp, p1, p2, K = 1.0, 5.0, 0.05, 1.4, 1.4, 50
+    result = sim.periodicResponse(Delta, freq, amp, p1, p2, K=K)
+    assert result['converged']
+    assert np.all(abs(result['multipliers']) < 1)
+
+    # Integrate through the transients with small RK4 steps and compare
+    # the last period with the orbit found by shooting
+    def f(t, y):
+        e1_tilda = np.sqrt(p1*(1 + amp*np.cos(2*np.pi*t/freq)))
+        return np.array(_fieldDerivatives(y[0], y[1], e1_tilda, np.sqrt(p2),
+                                          Delta, Delta))
+
+    m = 20
+    h = freq/(K*m)
+    y = np.array([result['e1'][0], result['e2'][0]])*(1 + 0.1j)
+    periods = 12
+    orbit = []
+    for k in range(periods*K*m):
+        t = k*h
+        if k >= (periods - 1)*K*m and k % m == 0:
+            orbit.append(y)
+        k1 = f(t, y)
+        k2 = f(t + h/2, y + h/2*k1)
+        k3 = f(t + h/2, y + h/2*k2)
+        k4 = f(t + h, y + h*k3)
+        y = y + h/6*(k1 + 2*k2 + 2*k3 + k4)
+    orbit = np.array(orbit)
+    assert np.allclose(orbit[:, 0], result['e1'], atol=1e-8)
+    assert np.allclose(orbit[:, 1], result['e2'], atol=1e-8)
+
+def test_batchSequentialParity():
+    # Below the bistable region (folds at 2.778 and 4.260 for p = 1.4)
+    # there is one steady state, which both scans must reach (to within
+    # where the relaxation stops, when |e1| changes by less than the noise
+    # in a step, which can happen on a turn of the spiral into the state)
+    sim = wgm_resonator(material, resonator)
+    scans = []
+    for batch in [False, True]:
+        Delta, pwr1, pwr2 = sim.frequencyScan(-4, 2, 1.4, 1.4, N=7,
+                                              batch=batch, plot=False,
+                                              progress=False,
+                                              rng=np.random.default_rng(0))
+        scans.append((pwr1, pwr2))
+    assert np.allclose(scans[0], scans[1], atol=1e-4)
+    I1, _ = _solveSteadyStates(Delta, 1.4, 1.4)
+    for pwr1, pwr2 in scans:
+        assert np.allclose(pwr1**2, I1[:, 0], atol=1e-4)
+        assert np.allclose(pwr2**2, I1[:, 0], atol=1e-4)